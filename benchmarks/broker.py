@@ -0,0 +1,303 @@
+"""
+ Minimal MQTT 3.1.1 and 5 broker stand-in for benchmarks.
+
+ Accepts any client, acknowledges QoS 1 publishes, keeps retained messages
+ and forwards publishes to matching subscriptions at QoS 0.  MQTT 5 clients
+ are granted topic aliases.  Every packet is counted so benchmarks can
+ report message and byte rates.
+"""
+
+import asyncio
+import struct
+import time
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# MQTT 5 property identifier -> value type
+PROPERTY_TYPES = {
+    0x01: "byte",  # payload format indicator
+    0x02: "int",  # message expiry interval
+    0x03: "string",  # content type
+    0x08: "string",  # response topic
+    0x09: "binary",  # correlation data
+    0x0B: "varint",  # subscription identifier
+    0x23: "short",  # topic alias
+    0x26: "pair",  # user property
+}
+TOPIC_ALIAS = 0x23
+TOPIC_ALIAS_MAXIMUM = 0x22
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(s):
+    data = s.encode() if isinstance(s, str) else s
+    return struct.pack(">H", len(data)) + data
+
+
+def decode_length(data, offset):
+    """Variable byte integer at offset, returns (value, next offset)."""
+    value = 0
+    multiplier = 1
+    while True:
+        byte = data[offset]
+        offset += 1
+        value += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            return value, offset
+
+
+def decode_properties(data, offset):
+    """MQTT 5 properties at offset, returns ({identifier: value}, next offset)."""
+    length, offset = decode_length(data, offset)
+    end = offset + length
+    properties = {}
+    while offset < end:
+        identifier = data[offset]
+        offset += 1
+        value_type = PROPERTY_TYPES[identifier]
+        if value_type == "byte":
+            value = data[offset]
+            offset += 1
+        elif value_type == "short":
+            (value,) = struct.unpack(">H", data[offset : offset + 2])
+            offset += 2
+        elif value_type == "int":
+            (value,) = struct.unpack(">I", data[offset : offset + 4])
+            offset += 4
+        elif value_type == "varint":
+            value, offset = decode_length(data, offset)
+        else:
+            strings = []
+            for _ in range(2 if value_type == "pair" else 1):
+                (length,) = struct.unpack(">H", data[offset : offset + 2])
+                strings.append(data[offset + 2 : offset + 2 + length])
+                offset += 2 + length
+            value = tuple(strings) if value_type == "pair" else strings[0]
+        properties.setdefault(identifier, []).append(value)
+    return properties, end
+
+
+def packet(packet_type, flags, body):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+class Session:
+    """One connected client."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = None
+        self.subscriptions = set()
+        self.v5 = False
+        self.aliases = {}  # topic alias -> topic, set by the client
+
+
+class Broker:
+    def __init__(self, topic_alias_maximum=65535):
+        self.topic_alias_maximum = topic_alias_maximum
+        self.server = None
+        self.port = None
+        self.sessions = set()
+        self.retained = {}  # topic -> payload
+        self.last_publish = {}  # topic -> (monotonic time, payload)
+        self.waiters = {}  # topic -> list of (payload, future)
+
+        # benchmark observations
+        self.publishes = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.connects = 0
+        self.aliased_publishes = 0
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for session in list(self.sessions):
+            session.writer.transport.abort()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def counters(self):
+        return {
+            "publishes": self.publishes,
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "aliased_publishes": self.aliased_publishes,
+        }
+
+    def expect(self, topic, payload=None):
+        """Future resolved with the arrival time of the next matching publish."""
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(topic, []).append((payload, future))
+        return future
+
+    def send(self, session, data):
+        self.bytes_sent += len(data)
+        session.writer.write(data)
+
+    def publish(self, topic, payload):
+        """Publish to subscribed clients, as a user's MQTT client would."""
+        body = encode_string(topic) + payload.encode()
+        data = packet(PUBLISH, 0, body)
+        # no properties
+        data_v5 = packet(PUBLISH, 0, encode_string(topic) + b"\x00" + payload.encode())
+        for session in self.sessions:
+            if any(topic_matches(f, topic) for f in session.subscriptions):
+                self.send(session, data_v5 if session.v5 else data)
+
+    async def read_packet(self, reader):
+        first = await reader.readexactly(1)
+        length = 0
+        multiplier = 1
+        header_len = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            header_len += 1
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        body = await reader.readexactly(length)
+        self.bytes_received += header_len + length
+        return first[0] >> 4, first[0] & 0x0F, body
+
+    def on_publish(self, session, flags, body):
+        self.publishes += 1
+        qos = (flags >> 1) & 0x03
+        (topic_len,) = struct.unpack(">H", body[:2])
+        topic = body[2 : 2 + topic_len].decode()
+        offset = 2 + topic_len
+        if qos:
+            packet_id = body[offset : offset + 2]
+            offset += 2
+            self.send(session, packet(PUBACK, 0, packet_id))
+        if session.v5:
+            properties, offset = decode_properties(body, offset)
+            alias = properties.get(TOPIC_ALIAS, [None])[0]
+            if alias is not None:
+                if topic:
+                    session.aliases[alias] = topic
+                else:
+                    self.aliased_publishes += 1
+                    topic = session.aliases[alias]
+        payload = body[offset:].decode(errors="replace")
+        now = time.monotonic()
+        self.last_publish[topic] = (now, payload)
+        if flags & 0x01:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        waiters = self.waiters.get(topic)
+        if waiters:
+            for expected, future in list(waiters):
+                if expected is None or expected == payload:
+                    waiters.remove((expected, future))
+                    if not future.done():
+                        future.set_result(now)
+
+    def on_connect(self, session, body):
+        self.connects += 1
+        (name_len,) = struct.unpack(">H", body[:2])
+        session.v5 = body[2 + name_len] == 5
+        if session.v5:
+            properties = struct.pack(
+                ">BH", TOPIC_ALIAS_MAXIMUM, self.topic_alias_maximum
+            )
+            body = b"\x00\x00" + encode_length(len(properties)) + properties
+        else:
+            body = b"\x00\x00"
+        self.send(session, packet(CONNACK, 0, body))
+
+    def on_subscribe(self, session, body):
+        packet_id = body[:2]
+        offset = 2
+        if session.v5:
+            _, offset = decode_properties(body, offset)
+        granted = bytearray()
+        while offset < len(body):
+            (topic_len,) = struct.unpack(">H", body[offset : offset + 2])
+            topic_filter = body[offset + 2 : offset + 2 + topic_len].decode()
+            offset += 2 + topic_len + 1
+            session.subscriptions.add(topic_filter)
+            granted.append(0)
+        properties = b"\x00" if session.v5 else b""
+        self.send(session, packet(SUBACK, 0, packet_id + properties + bytes(granted)))
+
+    def on_unsubscribe(self, session, body):
+        packet_id = body[:2]
+        offset = 2
+        if session.v5:
+            _, offset = decode_properties(body, offset)
+        reasons = bytearray()
+        while offset < len(body):
+            (topic_len,) = struct.unpack(">H", body[offset : offset + 2])
+            session.subscriptions.discard(
+                body[offset + 2 : offset + 2 + topic_len].decode()
+            )
+            offset += 2 + topic_len
+            reasons.append(0)
+        if session.v5:
+            packet_id += b"\x00" + bytes(reasons)
+        self.send(session, packet(UNSUBACK, 0, packet_id))
+
+    async def handle(self, reader, writer):
+        session = Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                packet_type, flags, body = await self.read_packet(reader)
+                if packet_type == CONNECT:
+                    self.on_connect(session, body)
+                elif packet_type == PUBLISH:
+                    self.on_publish(session, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    self.on_subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self.on_unsubscribe(session, body)
+                elif packet_type == PINGREQ:
+                    self.send(session, packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
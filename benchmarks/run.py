@@ -0,0 +1,543 @@
+#!/usr/bin/env python
+"""
+ Benchmarks for tuya_mqtt.
+
+ Runs server.py against simulated Tuya devices and an MQTT broker stand-in
+ and measures startup time, steady state publish throughput, set command
+ latency and recovery after all devices drop their connections at once.
+ The DeviceMonitor publish path, and the bytes per data value publish with
+ MQTT 3.1.1 and MQTT 5 topic aliases, are measured in process.  Results are
+ written as JSON, and compared against a baseline with --baseline.
+
+ Simulated devices listen on 127.0.x.y addresses so this needs Linux, where
+ all of 127.0.0.0/8 is loopback.
+
+ Usage: python benchmarks/run.py --devices 10 100 1000 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from broker import Broker
+from simulator import DeviceFleet
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# config.py for the server under test, startup limits are raised so large
+# fleets start in reasonable time
+BENCH_CONFIG = {
+    "LOGGING_LEVEL_CONSOLE": 30,  # logging.WARNING
+    "DEVICE_ANNOUNCE_LISTENER": False,
+    "DEVICE_FILE_WATCH_SECONDS": 0,
+    "DEVICE_STARTUP_CONCURRENCY": 50,
+    "DEVICE_STARTUP_RATE": 100,
+    "DEVICE_STARTUP_BURST": 50,
+    "DEVICE_RECONNECT_CONCURRENCY": 50,
+}
+
+
+def format_homie_id(s):
+    return re.sub(r"[\W_]", "", s).lower()
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max": values[-1],
+        "count": len(values),
+    }
+
+
+def process_usage(pid):
+    """CPU seconds and resident memory of pid from /proc, if available."""
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/{}/status".format(pid)) as f:
+            rss = next(line for line in f if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return {}
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / ticks,
+        "rss_bytes": int(rss.split()[1]) * 1024,
+    }
+
+
+async def wait_until(condition, timeout, interval=0.01):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+class ServerUnderTest:
+    """server.py run as its main entry point in a scratch directory."""
+
+    def __init__(self, fleet, broker, config):
+        self.fleet = fleet
+        self.broker = broker
+        self.config = dict(BENCH_CONFIG, **config)
+        self.directory = tempfile.TemporaryDirectory(prefix="tuya_mqtt_bench_")
+        self.process = None
+
+    def write_files(self):
+        devices_info = self.fleet.devices_info()
+        config = dict(self.config, MQTT_HOST="127.0.0.1", MQTT_PORT=self.broker.port)
+        with open(os.path.join(self.directory.name, "config.py"), "w") as f:
+            for k, v in config.items():
+                f.write("{} = {!r}\n".format(k, v))
+        with open(os.path.join(self.directory.name, "devices.json"), "w") as f:
+            json.dump(devices_info, f)
+        # known addresses, so no network scan is needed
+        with open(os.path.join(self.directory.name, "device_addresses.json"), "w") as f:
+            json.dump(
+                {
+                    di["id"]: {"ip": di["ip"], "version": di["version"]}
+                    for di in devices_info
+                },
+                f,
+            )
+
+    async def start(self):
+        self.write_files()
+        code = (
+            "import runpy, sys; sys.path.append({!r}); "
+            "runpy.run_path({!r}, run_name='__main__')"
+        ).format(REPO_DIR, os.path.join(REPO_DIR, "server.py"))
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", code, cwd=self.directory.name
+        )
+
+    def usage(self):
+        return process_usage(self.process.pid)
+
+    async def stop(self):
+        if self.process.returncode is None:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), 10)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        self.directory.cleanup()
+
+
+class Scenarios:
+    def __init__(self, count, args):
+        self.count = count
+        self.args = args
+        self.broker = Broker()
+        self.fleet = DeviceFleet(count, versions=args.versions)
+        self.server = ServerUnderTest(self.fleet, self.broker, args.config)
+        self.state_topics = [
+            "{}/{}/$state".format("homie", format_homie_id(di["name"]))
+            for di in self.fleet.devices_info()
+        ]
+
+    def ready(self, since=None):
+        ready = 0
+        for topic in self.state_topics:
+            published = self.broker.last_publish.get(topic)
+            if published is None or published[1] != "ready":
+                continue
+            if since is None or published[0] >= since:
+                ready += 1
+        return ready
+
+    async def startup(self):
+        start = time.monotonic()
+        await self.server.start()
+        first = None
+        deadline = start + self.args.timeout
+        while self.ready() < self.count and time.monotonic() < deadline:
+            if first is None and self.ready():
+                first = time.monotonic() - start
+            await asyncio.sleep(0.01)
+        return {
+            "first_ready_seconds": first,
+            "all_ready_seconds": (
+                time.monotonic() - start if self.ready() == self.count else None
+            ),
+            "ready": self.ready(),
+        }
+
+    async def throughput(self):
+        self.fleet.set_churn(self.args.churn)
+        await asyncio.sleep(1)  # let the churn settle
+        before = self.broker.counters()
+        pushes = self.fleet.pushes()
+        start = time.monotonic()
+        await asyncio.sleep(self.args.duration)
+        elapsed = time.monotonic() - start
+        after = self.broker.counters()
+        self.fleet.set_churn(0)
+        published = after["publishes"] - before["publishes"]
+        pushed = self.fleet.pushes() - pushes
+        return {
+            "device_messages_per_second": pushed / elapsed,
+            "publishes_per_second": published / elapsed,
+            "mqtt_bytes_per_second": (
+                after["bytes_received"] - before["bytes_received"]
+            )
+            / elapsed,
+            "publishes_per_device_message": published / pushed if pushed else None,
+            "mqtt_bytes_per_publish": (
+                (after["bytes_received"] - before["bytes_received"]) / published
+                if published
+                else None
+            ),
+        }
+
+    async def command_latency(self):
+        device_latency = []
+        round_trip = []
+        timeouts = 0
+        samples = self.fleet.devices[: self.args.commands]
+        for i in range(self.args.command_rounds):
+            for device in samples:
+                homie_id = format_homie_id(device.info["name"])
+                value = "true" if i % 2 == 0 else "false"
+                value_topic = "homie/{}/data/switch1".format(homie_id)
+                received = device.expect_command()
+                published = self.broker.expect(value_topic, value)
+                start = time.monotonic()
+                self.broker.publish(value_topic + "/set", value)
+                try:
+                    device_latency.append(
+                        await asyncio.wait_for(received, self.args.command_timeout)
+                        - start
+                    )
+                    round_trip.append(
+                        await asyncio.wait_for(published, self.args.command_timeout)
+                        - start
+                    )
+                except asyncio.TimeoutError:
+                    timeouts += 1
+        return {
+            "to_device_seconds": percentiles(device_latency),
+            "round_trip_seconds": percentiles(round_trip),
+            "timeouts": timeouts,
+        }
+
+    async def recovery(self):
+        connects = [d.connects for d in self.fleet.devices]
+        start = time.monotonic()
+        self.fleet.disconnect()
+        reconnected = await wait_until(
+            lambda: all(
+                d.connects > c and d.writers
+                for d, c in zip(self.fleet.devices, connects)
+            ),
+            self.args.timeout,
+        )
+        reconnect_seconds = time.monotonic() - start if reconnected else None
+        ready = await wait_until(
+            lambda: self.ready(since=start) == self.count, self.args.timeout
+        )
+        return {
+            "all_reconnected_seconds": reconnect_seconds,
+            "all_ready_seconds": time.monotonic() - start if ready else None,
+            "ready": self.ready(since=start),
+        }
+
+    async def run(self):
+        await self.broker.start()
+        await self.fleet.start()
+        results = {"devices": self.count}
+        try:
+            results["startup"] = await self.startup()
+            results["startup"].update(self.server.usage())
+            results["throughput"] = await self.throughput()
+            results["command_latency"] = await self.command_latency()
+            results["recovery"] = await self.recovery()
+            results["usage"] = self.server.usage()
+        finally:
+            await self.server.stop()
+            await self.fleet.stop()
+            await self.broker.stop()
+        return results
+
+
+def import_server(config_dir):
+    """server.py imported in process with a quiet config.py."""
+    with open(os.path.join(config_dir, "config.py"), "w") as f:
+        f.write("LOGGING_LEVEL_CONSOLE = 30\n")
+        f.write("DEVICE_SNAPSHOT_DIR = None\n")
+    sys.path[:0] = [config_dir, REPO_DIR]
+    import server
+
+    return server
+
+
+def create_monitors(server, bridge, count):
+    """Initialised DeviceMonitors of a plug fleet, with their data points."""
+    monitors = []
+    for di in DeviceFleet(count).devices_info():
+        m = server.DeviceMonitor(di, bridge, None, None, None)
+        dps_objects = [
+            SimpleNamespace(
+                name="switch_1", value_type="boolean", settable=True, value=False
+            ),
+            SimpleNamespace(
+                name="cur_power",
+                value_type="integer",
+                settable=False,
+                int_step=1,
+                int_min=0,
+                int_max=50000,
+                unit="W",
+                value=0,
+            ),
+        ]
+        m.status = {"dps_objects": dps_objects}
+        m.homie_init()
+        monitors.append((m, dps_objects))
+    return monitors
+
+
+def monitor_publish(count, rounds):
+    """In process DeviceMonitor publish path, no network involved."""
+    config_dir = tempfile.TemporaryDirectory(prefix="tuya_mqtt_bench_")
+    server = import_server(config_dir.name)
+
+    class CountingBridge:
+        state_topic = "tuya_mqtt/$state"
+        published = 0
+
+        def register(self, monitor):
+            pass
+
+        def publish(self, topic, message):
+            self.published += 1
+
+        def publish_value(self, topic, message, expiry=None):
+            self.published += 1
+
+    bridge = CountingBridge()
+    tracemalloc.start()
+    monitors = create_monitors(server, bridge, count)
+    # memory held by monitors and their Homie descriptions after init
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    published = bridge.published
+    start = time.perf_counter()
+    for i in range(rounds):
+        for m, dps_objects in monitors:
+            dps_objects[1].value = i % 7  # some values repeat
+            m.homie_publish_dps_objects(dps_objects)
+    elapsed = time.perf_counter() - start
+    config_dir.cleanup()
+    updates = rounds * len(monitors)
+    return {
+        "devices": count,
+        "updates_per_second": updates / elapsed,
+        "publishes_per_update": (bridge.published - published) / updates,
+        "bytes_per_device": allocated // count,
+    }
+
+
+def mqtt_wire(count, rounds, topic_alias_maximum):
+    """Bytes on the wire per data value publish, MQTT 3.1.1 against MQTT 5."""
+    config_dir = tempfile.TemporaryDirectory(prefix="tuya_mqtt_bench_")
+    server = import_server(config_dir.name)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    broker = Broker(topic_alias_maximum)
+    asyncio.run_coroutine_threadsafe(broker.start(), loop).result()
+
+    results = {"devices": count}
+    timestamp_property = server.MQTT_TIMESTAMP_PROPERTY
+    modes = (
+        ("mqtt311", False, None),
+        ("mqtt5", True, None),
+        ("mqtt5_timestamp", True, "timestamp"),
+    )
+    for name, v5, timestamp in modes:
+        server.MQTT_TIMESTAMP_PROPERTY = timestamp
+        bridge = server.MqttBridge(
+            server.ReconnectScheduler(), client_id="bench-" + name, v5=v5
+        )
+        bridge.connect(host="127.0.0.1", port=broker.port)
+        bridge.ready.wait(10)
+        monitors = create_monitors(server, bridge, count)
+        for m, dps_objects in monitors:
+            m.homie_publish_dps_objects(dps_objects)
+        # let descriptions and first values (defining aliases) arrive first
+        published = -1
+        while broker.publishes != published:
+            published = broker.publishes
+            time.sleep(0.2)
+        before = broker.counters()
+        for i in range(rounds):
+            for m, dps_objects in monitors:
+                dps_objects[1].value = i + 1  # every round publishes
+                m.homie_publish_dps_objects(dps_objects)
+        expected = before["publishes"] + rounds * len(monitors)
+        deadline = time.monotonic() + 60
+        while broker.publishes < expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        after = broker.counters()
+        bridge.mqtt.disconnect()
+        bridge.mqtt.loop_stop()
+        for m, _ in monitors:
+            bridge.unregister(m)
+        published = after["publishes"] - before["publishes"]
+        results[name] = {
+            "bytes_per_publish": (after["bytes_received"] - before["bytes_received"])
+            / published,
+            "aliased": (after["aliased_publishes"] - before["aliased_publishes"])
+            / published,
+        }
+    server.MQTT_TIMESTAMP_PROPERTY = timestamp_property
+    asyncio.run_coroutine_threadsafe(broker.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    config_dir.cleanup()
+    return results
+
+
+# direction of each result, for comparing against a baseline
+LOWER_IS_BETTER = (
+    "_seconds",
+    "p50",
+    "p95",
+    "max",
+    "timeouts",
+    "cpu_seconds",
+    "rss_bytes",
+    "bytes_per_device",
+    "bytes_per_publish",
+)
+HIGHER_IS_BETTER = ("updates_per_second", "publishes_per_second")
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    if isinstance(results, dict):
+        for k, v in results.items():
+            flat.update(flatten(v, "{}{}.".format(prefix, k)))
+    elif isinstance(results, list):
+        for v in results:
+            if isinstance(v, dict) and "devices" in v:
+                flat.update(flatten(v, "{}{}.".format(prefix, v["devices"])))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        flat[prefix.rstrip(".")] = results
+    return flat
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    current = flatten(results)
+    for key, old in flatten(baseline).items():
+        new = current.get(key)
+        if new is None or not old:
+            continue
+        if key.endswith(HIGHER_IS_BETTER):
+            change = (old - new) / old
+        elif key.endswith(LOWER_IS_BETTER):
+            change = (new - old) / old
+        else:
+            continue
+        if change > tolerance:
+            found.append({"metric": key, "baseline": old, "current": new})
+    return found
+
+
+def parse_config(items):
+    config = {}
+    for item in items:
+        k, v = item.split("=", 1)
+        try:
+            config[k] = json.loads(v)
+        except ValueError:
+            config[k] = v
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--devices", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--versions", nargs="+", default=["3.3", "3.4", "3.5"])
+    parser.add_argument("--engine", default="threads", choices=["threads", "asyncio"])
+    parser.add_argument(
+        "--set",
+        dest="config",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="config.py override for the server, value parsed as JSON",
+    )
+    parser.add_argument(
+        "--churn", type=float, default=1.0, help="DP changes per device per second"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="throughput seconds"
+    )
+    parser.add_argument(
+        "--commands", type=int, default=10, help="devices sent commands"
+    )
+    parser.add_argument("--command-rounds", type=int, default=4)
+    parser.add_argument("--command-timeout", type=float, default=10.0)
+    parser.add_argument(
+        "--timeout", type=float, default=300.0, help="startup and recovery limit"
+    )
+    parser.add_argument("--publish-rounds", type=int, default=200)
+    parser.add_argument(
+        "--topic-alias-maximum",
+        type=int,
+        default=65535,
+        help="MQTT 5 topic aliases the broker grants (mosquitto defaults to 10)",
+    )
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--baseline", help="compare with an earlier JSON result file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    args.config = dict(parse_config(args.config), DEVICE_ENGINE=args.engine)
+
+    results = {
+        "time": time.time(),
+        "python": sys.version.split()[0],
+        "config": dict(BENCH_CONFIG, **args.config),
+        "monitor_publish": [
+            monitor_publish(n, args.publish_rounds) for n in args.devices
+        ],
+        "mqtt_wire": [
+            mqtt_wire(n, args.publish_rounds // 10 or 1, args.topic_alias_maximum)
+            for n in args.devices
+        ],
+        "server": [],
+    }
+    for count in args.devices:
+        results["server"].append(asyncio.run(Scenarios(count, args).run()))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["regressions"] = regressions(results, json.load(f), args.tolerance)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    if results.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
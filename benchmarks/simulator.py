@@ -0,0 +1,279 @@
+"""
+ Simulated Tuya devices for benchmarks.
+
+ Each device listens on its own loopback address at the Tuya TCP port and
+ speaks the 3.3, 3.4 or 3.5 local protocol using the tinytuya framing and
+ encryption helpers.  Devices answer status queries, heartbeats and set
+ commands and push data point changes at a configurable rate.
+"""
+
+import asyncio
+import hmac
+import json
+import os
+import random
+import struct
+import time
+from hashlib import sha256
+
+import tinytuya
+
+TUYA_PORT = 6668
+
+# data point mapping as written by the tinytuya wizard
+MAPPING = {
+    "1": {"code": "switch_1", "type": "Boolean", "values": {}},
+    "18": {
+        "code": "cur_current",
+        "type": "Integer",
+        "values": {"unit": "mA", "min": 0, "max": 30000, "scale": 0, "step": 1},
+    },
+    "19": {
+        "code": "cur_power",
+        "type": "Integer",
+        "values": {"unit": "W", "min": 0, "max": 50000, "scale": 1, "step": 1},
+    },
+    "20": {
+        "code": "cur_voltage",
+        "type": "Integer",
+        "values": {"unit": "V", "min": 0, "max": 5000, "scale": 1, "step": 1},
+    },
+}
+CHURN_DPS = ["18", "19", "20"]
+
+
+def device_address(index):
+    # 127.0.0.0/8 is all loopback on Linux, one address per device
+    return "127.0.{}.{}".format(1 + index // 250, 1 + index % 250)
+
+
+def device_info(index, version):
+    dev_id = "bench{:015d}".format(index)
+    return {
+        "id": dev_id,
+        "name": "Bench Plug {}".format(index),
+        "key": "{:016d}".format(index)[-16:],
+        "version": version,
+        "ip": device_address(index),
+        "sn": dev_id,
+        "product_id": "benchplug{}".format(version.replace(".", "")),
+        "product_name": "Bench Plug",
+        "mapping": MAPPING,
+    }
+
+
+class SimulatedDevice:
+    """One device, serving a single client connection at a time."""
+
+    def __init__(self, info, churn_per_second=0.0):
+        self.info = info
+        self.id = info["id"]
+        self.address = info["ip"]
+        self.version = float(info["version"])
+        self.version_header = info["version"].encode() + tinytuya.PROTOCOL_3x_HEADER
+        self.real_key = info["key"].encode()
+        self.churn_per_second = churn_per_second
+        self.dps = {"1": False, "18": 0, "19": 0, "20": 2300}
+        self.server = None
+        self.writers = set()
+        self.seqno = 1
+
+        # benchmark observations
+        self.connects = 0
+        self.connect_times = []
+        self.commands = []  # (monotonic time, dps)
+        self.command_waiters = []
+        self.pushes = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle, self.address, TUYA_PORT, reuse_address=True
+        )
+
+    def expect_command(self):
+        """Future resolved with the arrival time of the next set command."""
+        future = asyncio.get_running_loop().create_future()
+        self.command_waiters.append(future)
+        return future
+
+    def disconnect(self):
+        for writer in list(self.writers):
+            writer.transport.abort()
+
+    async def stop(self):
+        self.disconnect()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def frame(self, cmd, payload, key):
+        hmac_key = key if self.version >= 3.4 else None
+        if self.version >= 3.5:
+            msg = tinytuya.TuyaMessage(
+                self.seqno, cmd, 0, payload, 0, True, tinytuya.PREFIX_6699_VALUE, True
+            )
+        else:
+            payload = struct.pack(">I", 0) + payload
+            msg = tinytuya.TuyaMessage(
+                self.seqno, cmd, 0, payload, 0, True, tinytuya.PREFIX_55AA_VALUE, False
+            )
+        self.seqno += 1
+        return tinytuya.pack_message(msg, hmac_key=hmac_key)
+
+    def encode(self, cmd, data, key, header):
+        payload = json.dumps(data, separators=(",", ":")).encode() if data else b""
+        if self.version >= 3.5:
+            if header:
+                payload = self.version_header + payload
+        elif self.version >= 3.4:
+            if header:
+                payload = self.version_header + payload
+            if payload:
+                payload = tinytuya.AESCipher(key).encrypt(payload, False)
+        elif payload:
+            payload = tinytuya.AESCipher(key).encrypt(payload, False)
+            if header:
+                payload = self.version_header + payload
+        return self.frame(cmd, payload, key)
+
+    def decode(self, msg, key):
+        payload = msg.payload
+        if self.version == 3.4 and payload:
+            payload = tinytuya.AESCipher(key).decrypt(payload, False, decode_text=False)
+        if payload.startswith(self.version_header[:3]):
+            payload = payload[len(self.version_header) :]
+        if self.version < 3.4 and payload:
+            payload = tinytuya.AESCipher(key).decrypt(payload, False, decode_text=False)
+        return json.loads(payload) if payload else {}
+
+    def dps_message(self, dps):
+        t = int(time.time())
+        if self.version >= 3.4:
+            return {"protocol": 4, "t": t, "data": {"dps": dps}}
+        return {"devId": self.id, "dps": dps, "t": t}
+
+    async def read_message(self, reader, key):
+        data = await reader.readexactly(4)
+        header_fmt = tinytuya.MESSAGE_HEADER_FMT_55AA
+        if data == tinytuya.PREFIX_6699_BIN:
+            header_fmt = tinytuya.MESSAGE_HEADER_FMT_6699
+        data += await reader.readexactly(struct.calcsize(header_fmt) - 4)
+        header = tinytuya.parse_header(data)
+        data += await reader.readexactly(header.total_length - len(data))
+        hmac_key = key if self.version >= 3.4 else None
+        return tinytuya.unpack_message(
+            data, hmac_key=hmac_key, header=header, no_retcode=True
+        )
+
+    async def negotiate(self, reader, writer, msg):
+        # 3.4/3.5 session key: XOR of both nonces encrypted with the real key
+        local_nonce = msg.payload
+        if self.version == 3.4:
+            local_nonce = tinytuya.AESCipher(self.real_key).decrypt(
+                local_nonce, False, decode_text=False
+            )
+        local_nonce = local_nonce[:16]
+        remote_nonce = os.urandom(16)
+        response = remote_nonce + hmac.new(self.real_key, local_nonce, sha256).digest()
+        if self.version == 3.4:
+            response = tinytuya.AESCipher(self.real_key).encrypt(response, False)
+        writer.write(self.frame(tinytuya.SESS_KEY_NEG_RESP, response, self.real_key))
+        await self.read_message(reader, self.real_key)  # SESS_KEY_NEG_FINISH
+        key = bytes(a ^ b for a, b in zip(local_nonce, remote_nonce))
+        cipher = tinytuya.AESCipher(self.real_key)
+        if self.version == 3.4:
+            return cipher.encrypt(key, False, pad=False)
+        return cipher.encrypt(key, use_base64=False, pad=False, iv=local_nonce[:12])[
+            12:28
+        ]
+
+    async def handle(self, reader, writer):
+        self.connects += 1
+        self.connect_times.append(time.monotonic())
+        self.writers.add(writer)
+        key = self.real_key
+        churn = None
+        try:
+            while True:
+                msg = await self.read_message(reader, key)
+                if msg.cmd == tinytuya.SESS_KEY_NEG_START:
+                    key = await self.negotiate(reader, writer, msg)
+                    continue
+                if msg.cmd in (tinytuya.DP_QUERY, tinytuya.DP_QUERY_NEW):
+                    data = self.dps_message(self.dps)
+                    writer.write(self.encode(msg.cmd, data, key, False))
+                    if churn is None:
+                        churn = asyncio.ensure_future(self.churn(writer, key))
+                elif msg.cmd == tinytuya.HEART_BEAT:
+                    writer.write(self.encode(msg.cmd, None, key, False))
+                elif msg.cmd in (tinytuya.CONTROL, tinytuya.CONTROL_NEW):
+                    request = self.decode(msg, key)
+                    dps = request.get("dps") or request.get("data", {}).get("dps", {})
+                    now = time.monotonic()
+                    self.commands.append((now, dps))
+                    for future in self.command_waiters:
+                        if not future.done():
+                            future.set_result(now)
+                    self.command_waiters.clear()
+                    self.dps.update(dps)
+                    writer.write(self.encode(msg.cmd, None, key, False))
+                    self.push(writer, key, dps)
+                elif msg.cmd == tinytuya.UPDATEDPS:
+                    writer.write(self.encode(msg.cmd, None, key, False))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, tinytuya.DecodeError):
+            pass
+        finally:
+            if churn is not None:
+                churn.cancel()
+            self.writers.discard(writer)
+            writer.close()
+
+    def push(self, writer, key, dps):
+        self.pushes += 1
+        writer.write(self.encode(tinytuya.STATUS, self.dps_message(dps), key, True))
+
+    async def churn(self, writer, key):
+        while True:
+            if self.churn_per_second <= 0:
+                await asyncio.sleep(0.5)
+                continue
+            await asyncio.sleep(random.expovariate(self.churn_per_second))
+            dp = random.choice(CHURN_DPS)
+            self.dps[dp] = random.randint(0, 3000)
+            self.push(writer, key, {dp: self.dps[dp]})
+
+
+class DeviceFleet:
+    """Starts count simulated devices cycling through protocol versions."""
+
+    def __init__(self, count, versions=("3.3", "3.4", "3.5"), churn_per_second=0.0):
+        self.devices = [
+            SimulatedDevice(
+                device_info(i, versions[i % len(versions)]), churn_per_second
+            )
+            for i in range(count)
+        ]
+
+    def devices_info(self):
+        return [d.info for d in self.devices]
+
+    async def start(self):
+        await asyncio.gather(*(d.start() for d in self.devices))
+
+    async def stop(self):
+        await asyncio.gather(*(d.stop() for d in self.devices))
+
+    def set_churn(self, churn_per_second):
+        for d in self.devices:
+            d.churn_per_second = churn_per_second
+
+    def disconnect(self):
+        for d in self.devices:
+            d.disconnect()
+
+    def connected(self):
+        return sum(1 for d in self.devices if d.writers)
+
+    def pushes(self):
+        return sum(d.pushes for d in self.devices)
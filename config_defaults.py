@@ -16,6 +16,13 @@ MQTT_KEEPALIVE = 60
 MQTT_CLIENT_ID = "tuya_mqtt"
 MQTT_USERNAME = None
 MQTT_PASSWORD = None
+MQTT_RECONNECT_SECONDS = 60  # maximum reconnect backoff
+MQTT_BRIDGE_TOPIC = "tuya_mqtt"  # bridge $state (will) is published below this
+MQTT_V5 = False  # MQTT 5, data values use topic aliases granted by the broker
+MQTT_TIMESTAMP_PROPERTY = None  # MQTT 5 user property with the time of data values
+# MQTT 5 expiry seconds of retained data values, keyed like
+# HOMIE_PUBLISH_FILTERS, for example {"*": {"cur_power": 600}}
+MQTT_MESSAGE_EXPIRY = {}
 
 # Homie Standard Items
 # https://homieiot.github.io/specification/spec-core-v4_0_0/
@@ -25,15 +32,67 @@ HOMIE_DEVICE_EXTENSIONS = ""
 HOMIE_INIT_SECONDS = 3600 * 24  # Daily
 HOMIE_MQTT_QOS = 1
 HOMIE_MQTT_RETAIN = True
-HOMIE_PUBLISH_ALL_SECONDS = 60
+HOMIE_PUBLISH_ALL_SECONDS = 60  # default status poll, only changes are published
+HOMIE_FULL_REFRESH_SECONDS = 3600  # republish all values even if unchanged
 HOMIE_IMPLEMENTATION = "tuya_mqtt"
 HOMIE_PUBLISH_DEVICE_INFO = False
+HOMIE_OPTIMISTIC_ECHO = False  # publish commanded values before the device confirms
+# publish filters by device id or product_id ("*" for all devices), then by
+# tuya code ("*" for all codes), for example
+# {"*": {"cur_power": {"deadband": 5, "deadband_percent": 2,
+#                      "min_interval": 10, "max_interval": 300}}}
+HOMIE_PUBLISH_FILTERS = {}
+# extra min, max or time weighted avg properties over tumbling windows for
+# numeric data points, keyed like HOMIE_PUBLISH_FILTERS, for example
+# {"*": {"cur_power": [("avg", 60), ("max", 60)]}} adds curpoweravg60s
+HOMIE_AGGREGATES = {}
 
 # Home Assistant
 HASS_BASE_TOPIC = "homeassistant"
 
+# Metrics
+METRICS_PORT = None  # serve Prometheus metrics on this port, e.g. 9108
+METRICS_BIND = "127.0.0.1"
+METRICS_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# Profiling, started by SIGUSR1 or by publishing seconds to
+# <MQTT_BRIDGE_TOPIC>/$profile/set (<MQTT_BRIDGE_TOPIC>/<worker>/... for workers)
+PROFILE_DIR = "profiles"
+PROFILE_SECONDS = 30
+PROFILE_INTERVAL_SECONDS = 0.01
+PROFILE_TOP_FUNCTIONS = 40  # functions listed per device
+
+# Supervisor
+SUPERVISOR_WORKERS = 1  # more than 1 shards devices over worker processes
+SUPERVISOR_REPORT_SECONDS = 60  # worker health and metrics report interval
+
 # tinytuya
 DEVICE_FILE = "devices.json"
-DEVICE_RECONNECT_SECONDS = 60
+DEVICE_FILE_WATCH_SECONDS = 10  # reload on change, 0 to reload only on SIGHUP
+DEVICE_STOP_TIMEOUT_SECONDS = 30
+DEVICE_ADDRESS_CACHE_FILE = "device_addresses.json"
+DEVICE_SNAPSHOT_DIR = None  # directory of snapshots published before connecting
+DEVICE_DISCOVERY_SECONDS = 18  # startup broadcast listen time for uncached devices
+DEVICE_ANNOUNCE_LISTENER = True  # reconnect as soon as a device broadcasts a new ip
+DEVICE_RECONNECT_SECONDS = 60  # maximum reconnect backoff
+DEVICE_RECONNECT_BASE_SECONDS = 2  # backoff after the immediate first retry
+DEVICE_RECONNECT_CONCURRENCY = 10  # devices reconnecting at the same time
+DEVICE_RESCAN_FAILURES = 3  # failed connects to a cached address before a scan
 DEVICE_ASSUME_DEAD_SECONDS = 360
-DEVICE_THREAD_START_GAP_SECONDS = 5
+DEVICE_HEARTBEAT_SECONDS = 10
+DEVICE_POLL_SECONDS = {}  # device id or product_id -> status poll seconds
+DEVICE_STARTUP_CONCURRENCY = 10  # devices connecting at the same time on startup
+DEVICE_STARTUP_RATE = 2  # device starts per second
+DEVICE_STARTUP_BURST = 5
+DEVICE_STARTUP_TIMEOUT_SECONDS = 60  # slot is released if not ready by then
+DEVICE_PRIORITY_FIELD = "priority"  # devices.json field, higher starts first
+DEVICE_RECEIVE_TIMEOUT_SECONDS = 5
+DEVICE_COMMAND_COALESCE_SECONDS = 0.05  # set commands within this window share a frame
+DEVICE_COMMAND_CONFIRM_SECONDS = 5  # refetch device state if a set is unconfirmed
+# Homie devices whose set commands go to all their devices (ids or names) at
+# once, codes are tuya code -> datatype or (datatype, format), for example
+# {"Lounge": {"devices": ["Lamp 1", "Lamp 2"], "codes": {"switch_1": "boolean"}}}
+DEVICE_GROUPS = {}
+DEVICE_ENGINE = "threads"  # or "asyncio" to run all devices on one event loop
+DEVICE_ASYNC_CONNECT_WORKERS = 8  # executor threads for connects in asyncio mode
+DEVICE_ASYNC_SOCKET_TIMEOUT_SECONDS = 0.1  # longest socket call on the event loop
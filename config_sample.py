@@ -16,6 +16,10 @@ import logging
 # MQTT user and password below only set if used
 # MQTT_USERNAME = "user"
 # MQTT_PASSWORD = "password"
+# MQTT_V5 = True  # smaller data value publishes if the broker supports MQTT 5
+# MQTT_TIMESTAMP_PROPERTY = "timestamp"  # adds about 28 bytes per publish
 
 # tinutuya
 # DEVICE_FILE = "devices.json"
+# DEVICE_ENGINE = "threads"  # or "asyncio" for large fleets
+# METRICS_PORT = 9108  # Prometheus metrics on http://127.0.0.1:9108/metrics
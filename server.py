@@ -7,12 +7,30 @@
 
 import tinytuya
 import json
+import sys
+import hashlib
+import os
+import fcntl
+import random
+import heapq
+import signal
+import bisect
+import multiprocessing
+import multiprocessing.connection
+import itertools
 import time
 import threading
+import asyncio
 import re
-from pprint import pprint
+import select
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+from types import SimpleNamespace
 import paho.mqtt.client as mqtt
-from datetime import datetime, timedelta
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 import logging
 from config_defaults import *
@@ -43,70 +61,765 @@ def format_homie_id(s):
     return re.sub(r"[\W_]", "", s).lower()
 
 
-class DeviceMonitor:
-    def __init__(self, device_info):
-        self.id = device_info["id"]
-        self.homie_device_id = self.id
-        self.key = device_info["key"]
-        self.name = device_info["name"]
-        self.label = device_info["name"]  # + "(" + device_info['id'] + ")"
-        self.version = float(device_info["version"])
-        self.device_info = device_info
-        self.homie_device_id = format_homie_id(self.name)
-        self.homie_device_info = []  # list of nodes and properties
-        self.homie_init_time = datetime(1900, 1, 1)
-        self.homie_publish_all_time = datetime(1900, 1, 1)
-        self.tuya_last_data_time = datetime.now()
+def encode_boolean(value):
+    return ("{}".format(value)).lower()
 
-        logger.info("Initialising device instance for {}...".format(self.label))
 
-        # mqtt client
-        self.mqtt = mqtt.Client(
-            client_id="{}-{}".format(MQTT_CLIENT_ID, self.homie_device_id)
-        )
-        self.mqtt.on_message = self.homie_message
+def encode_value(value):
+    return "{}".format(value)
 
-        # MQTT Will
-        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, self.homie_device_id, "$state")
-        self.mqtt.will_set(
-            topic, payload="lost", qos=HOMIE_MQTT_QOS, retain=HOMIE_MQTT_RETAIN
+
+def bitmap_encoder(bitmap_value):
+    def encode(value):
+        return ("{}".format(bitmap_value in value)).lower()
+
+    return encode
+
+
+def parse_boolean(m):
+    if m in ["true", "True", "TRUE"]:
+        return True
+    elif m in ["false", "False", "FALSE"]:
+        return False
+    raise ValueError(m)
+
+
+# homie datatype -> parser for received set messages
+HOMIE_PARSERS = {
+    "boolean": parse_boolean,
+    "enum": str,
+    "string": str,
+    "integer": int,
+    "float": float,
+}
+
+
+# data point attributes describing its schema
+DP_SCHEMA_FIELDS = (
+    "name",
+    "value_type",
+    "settable",
+    "int_step",
+    "int_min",
+    "int_max",
+    "unit",
+    "enum_range",
+    "bitmap",
+)
+
+
+def dp_setting(settings, device_info, tuya_code):
+    """Entry of a device -> tuya code config table, most specific first.
+
+    Devices are matched by id, then product_id, then "*" and codes by name,
+    then "*".
+    """
+    for device_key in (device_info["id"], device_info.get("product_id"), "*"):
+        codes = settings.get(device_key)
+        if codes is None:
+            continue
+        for code_key in (tuya_code, "*"):
+            if code_key in codes:
+                return codes[code_key]
+    return None
+
+
+class PublishFilter:
+    """Deadband and publish rate limits for one property.
+
+    Changes smaller than the deadbands are dropped, changes within
+    min_interval of the last publish are held back and published once the
+    interval has passed, and the last value is republished if nothing was
+    published for max_interval.
+    """
+
+    def __init__(self, deadband=0, deadband_percent=0, min_interval=0, max_interval=0):
+        self.deadband = deadband
+        self.deadband_percent = deadband_percent
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.value = None  # last published value
+        self.message = None
+        self.time = float("-inf")
+        self.pending = None  # (value, message) held back by min_interval
+
+    def significant(self, value):
+        if self.message is None:
+            return True
+        if value == self.value:
+            return False
+        if (
+            isinstance(value, bool)
+            or not isinstance(value, (int, float))
+            or not isinstance(self.value, (int, float))
+        ):
+            return True
+        change = abs(value - self.value)
+        if change < self.deadband:
+            return False
+        if change < abs(self.value) * self.deadband_percent / 100:
+            return False
+        return True
+
+    def reset(self):
+        """Forget the last publish so the next value is published."""
+        self.value = None
+        self.message = None
+        self.time = float("-inf")
+        self.pending = None
+
+    def published(self, value, message, now):
+        self.value = value
+        self.message = message
+        self.time = now
+        self.pending = None
+        return message
+
+    def offer(self, value, message, now):
+        """Message to publish now or None."""
+        if not self.significant(value):
+            # back within the deadband of what was published
+            self.pending = None
+            return None
+        if now - self.time < self.min_interval:
+            self.pending = (value, message)
+            return None
+        return self.published(value, message, now)
+
+    def due(self, now):
+        """Held back change or keepalive to publish, or None."""
+        if self.pending is not None:
+            if now - self.time >= self.min_interval:
+                return self.published(*self.pending, now)
+        elif (
+            self.max_interval
+            and self.message is not None
+            and now - self.time >= self.max_interval
+        ):
+            self.time = now
+            return self.message
+        return None
+
+
+class Aggregate:
+    """Tumbling window min, max or time weighted average of a numeric value.
+
+    Windows are aligned to wall clock multiples of seconds.  Only running
+    totals are kept, the last value carries over into the next window.
+    """
+
+    def __init__(self, function, seconds):
+        self.function = function
+        self.seconds = seconds
+        self.window = None  # index of the current window
+        self.start = None  # time the current window was first observed
+        self.time = None  # time up to which the area is accumulated
+        self.value = None  # last value
+        self.area = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, now):
+        """Adds a value, returns the result of a window it closed or None."""
+        result = self.due(now)
+        if self.window is None:
+            self.window = int(now // self.seconds)
+            self.start = now
+            self.min = self.max = value
+        else:
+            self.area += self.value * (now - self.time)
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+        self.time = now
+        self.value = value
+        return result
+
+    def due(self, now):
+        """Result of the window if it ended before now, otherwise None."""
+        if self.window is None or int(now // self.seconds) == self.window:
+            return None
+        end = (self.window + 1) * self.seconds
+        if self.function == "min":
+            result = self.min
+        elif self.function == "max":
+            result = self.max
+        else:
+            self.area += self.value * (end - self.time)
+            result = self.area / (end - self.start) if end > self.start else self.value
+        self.window = int(now // self.seconds)
+        self.start = self.time = self.window * self.seconds
+        self.area = 0
+        self.min = self.max = self.value
+        return round(result, 3)
+
+
+# interned attribute values shared by all properties
+HOMIE_TRUE = sys.intern("true")
+HOMIE_FALSE = sys.intern("false")
+
+
+def homie_boolean(value):
+    return HOMIE_TRUE if value else HOMIE_FALSE
+
+
+class HomieProperty:
+    """Homie property, its attributes are serialised when published."""
+
+    __slots__ = (
+        "topic",
+        "tuya_code",
+        "name",
+        "datatype",
+        "settable",
+        "retained",
+        "format",
+        "unit",
+        "bitmap_value",
+        "aggregate",
+        "hass",
+    )
+
+    def __init__(
+        self,
+        topic,
+        tuya_code,
+        name,
+        datatype,
+        settable=False,
+        retained=None,
+        format=None,
+        unit=None,
+        bitmap_value=None,
+        aggregate=None,
+    ):
+        self.topic = sys.intern(topic)
+        self.tuya_code = sys.intern(tuya_code)
+        self.name = name
+        self.datatype = sys.intern(datatype)
+        self.settable = settable
+        self.retained = retained
+        self.format = format
+        self.unit = unit
+        self.bitmap_value = bitmap_value
+        self.aggregate = aggregate  # (function, seconds) of aggregate properties
+        self.hass = None  # (component, config, commandable) once rendered
+
+    def attributes(self):
+        attributes = [
+            ("$name", self.name),
+            ("$settable", homie_boolean(self.settable)),
+            ("$datatype", self.datatype),
+        ]
+        if self.retained is not None:
+            attributes.append(("$retained", homie_boolean(self.retained)))
+        if self.format is not None:
+            attributes.append(("$format", self.format))
+        if self.unit is not None:
+            attributes.append(("$unit", self.unit))
+        return attributes
+
+
+class HomieNode:
+    __slots__ = ("topic", "name", "properties")
+
+    def __init__(self, topic, name, properties):
+        self.topic = sys.intern(topic)
+        self.name = name
+        self.properties = properties
+
+    def attributes(self):
+        return [
+            ("$name", self.name),
+            ("$properties", ",".join(p.topic for p in self.properties)),
+        ]
+
+
+class HomieDevice:
+    __slots__ = ("name", "nodes")
+
+    def __init__(self, name, nodes):
+        self.name = name
+        self.nodes = nodes
+
+    def attributes(self):
+        return [
+            ("$homie", HOMIE_DEVICE_VERSION),
+            ("$name", self.name),
+            ("$nodes", ",".join(n.topic for n in self.nodes)),
+            ("$implementation", HOMIE_IMPLEMENTATION),
+        ]
+
+
+def device_info_property(topic, tuya_code, name, datatype="string"):
+    return HomieProperty(topic, tuya_code, name, datatype, retained=True)
+
+
+# static nodes describing devices.json fields, shared by all devices
+DEVICE_INFO_NODES = (
+    HomieNode(
+        "deviceinfo",
+        "Device info",
+        (
+            device_info_property("id", "id", "Tuya Device ID"),
+            device_info_property("mac", "mac", "Device MAC"),
+            device_info_property("uuid", "uuid", "UUID"),
+            device_info_property("sn", "sn", "Serial Number"),
+            device_info_property("sub", "sub", "Sub Device", "boolean"),
+            device_info_property("icon", "icon", "Icon URL"),
+            # device_info_property("ip", "ip", "Device IP"),
+            device_info_property("version", "version", "Tuya Version"),
+        ),
+    ),
+    HomieNode(
+        "productinfo",
+        "Product info",
+        (
+            device_info_property("category", "category", "Category"),
+            device_info_property("productname", "product_name", "Product Name"),
+            device_info_property("productid", "product_id", "Product ID"),
+            device_info_property("biztype", "biz_type", "Biz Type", "integer"),
+        ),
+    ),
+)
+
+
+def hass_property_config(p):
+    """Device independent HASS discovery of a property.
+
+    Returns the component, the serialised config without braces and whether
+    it needs a command topic.
+    """
+    component = "Unknown"
+    config = {"name": p.name}
+    commandable = False
+    if p.datatype == "boolean":
+        config["payload_off"] = "false"
+        config["payload_on"] = "true"
+        if p.settable:
+            component = "switch"
+            config["optimistic"] = False
+            commandable = True
+        else:
+            component = "binary_sensor"
+    elif p.datatype in ("float", "integer"):
+        if p.unit is not None:
+            config["unit_of_measurement"] = p.unit
+        if p.settable:
+            component = "number"
+            config["optimistic"] = False
+            commandable = True
+            if p.format is not None:
+                config["min"], config["max"] = p.format.split(":")
+        else:
+            component = "sensor"
+    elif p.datatype == "string":
+        if p.settable:
+            component = "text"
+            config["optimistic"] = False
+            commandable = True
+        else:
+            component = "sensor"
+    elif p.datatype == "enum":
+        options = p.format.split(",")
+        if len(options) == 2 and "On" in options and "Off" in options:
+            config["payload_off"] = "Off"
+            config["payload_on"] = "On"
+            if p.settable:
+                component = "switch"
+                config["optimistic"] = False
+                commandable = True
+            else:
+                component = "binary_sensor"
+        else:
+            if p.settable:
+                component = "select"
+                config["optimistic"] = False
+                commandable = True
+                config["options"] = options
+            else:
+                component = "sensor"
+    return component, json.dumps(config)[1:-1], commandable
+
+
+def homie_attributes(homie_device_id, device):
+    """Retained Homie description of a device as (topic, message) pairs."""
+    device_topic = "{}/{}".format(HOMIE_BASE_TOPIC, homie_device_id)
+    for k, v in device.attributes():
+        yield device_topic + "/" + k, v
+    for n in device.nodes:
+        node_topic = device_topic + "/" + n.topic
+        for k, v in n.attributes():
+            yield node_topic + "/" + k, v
+        for p in n.properties:
+            property_topic = node_topic + "/" + p.topic
+            for k, v in p.attributes():
+                yield property_topic + "/" + k, v
+
+
+def hass_configs(homie_device_id, nodes, common, label):
+    """HASS discovery (topic, message) pairs of the properties of nodes.
+
+    common is the serialised device part of the config without braces.
+    """
+    for n in nodes:
+        for p in n.properties:
+            if p.hass is None:
+                p.hass = hass_property_config(p)
+            component, fragment, commandable = p.hass
+            if component == "Unknown":
+                logger.error(
+                    "Could not represent property {} of node {} for {}.".format(
+                        p.topic, n.topic, label
+                    )
+                )
+                continue
+            unique_id = homie_device_id + "_" + n.topic + "_" + p.topic
+            state_topic = "{}/{}/{}/{}".format(
+                HOMIE_BASE_TOPIC, homie_device_id, n.topic, p.topic
+            )
+            device_config = {"state_topic": state_topic, "unique_id": unique_id}
+            if commandable:
+                device_config["command_topic"] = state_topic + "/set"
+            topic = "{}/{}/{}/{}".format(
+                HASS_BASE_TOPIC,
+                component,
+                unique_id,
+                "config",
+            )
+            yield topic, "{" + ", ".join(
+                [fragment, json.dumps(device_config)[1:-1], common]
+            ) + "}"
+
+
+def dp_schema_key(dps_objects):
+    return tuple(
+        tuple(
+            tuple(v) if isinstance(v, list) else v
+            for v in (getattr(dp, k, None) for k in DP_SCHEMA_FIELDS)
         )
-        # MQTT callback
+        for dp in dps_objects
+    )
+
+
+# data node properties by product and DP schema, shared by all devices of a
+# product and never modified once built
+SCHEMA_CACHE = {}
+
+
+def device_gateway_id(device_info):
+    """Id of the gateway a sub device is reached through, None for others."""
+    if device_info.get("sub") and device_info.get("parent"):
+        return device_info["parent"]
+    return None
+
+
+def device_groups(devices_info):
+    """Device entries by the id of the device whose connection they share.
+
+    Each group is a device entry followed by its sub devices.  Sub devices
+    whose gateway is not in the device file cannot be reached.
+    """
+    groups = {di["id"]: [di] for di in devices_info if device_gateway_id(di) is None}
+    for di in devices_info:
+        gateway_id = device_gateway_id(di)
+        if gateway_id is None:
+            continue
+        if gateway_id in groups:
+            groups[gateway_id].append(di)
+        else:
+            logger.error(
+                "Gateway {} of {} is not in the device file.".format(
+                    gateway_id, di["name"]
+                )
+            )
+    return groups
+
+
+def device_group_keys(devices_info):
+    """Shard keys keeping the devices of each of DEVICE_GROUPS together.
+
+    Groups sharing a device are merged so one worker reaches every device of
+    a group and no group runs on two workers.  Returns connection owner id
+    (the gateway of sub devices) -> key for the devices in a group.
+    """
+    parents = {}
+
+    def find(node):
+        parents.setdefault(node, node)
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    owners = {}  # device id or name -> connection owner id
+    for di in devices_info:
+        owners[di["id"]] = device_gateway_id(di) or di["id"]
+    for di in devices_info:
+        owners.setdefault(di["name"], owners[di["id"]])
+    for name, settings in DEVICE_GROUPS.items():
+        for member in settings.get("devices", ()):
+            owner = owners.get(member)
+            if owner is not None:
+                parents[find(("group", name))] = find(owner)
+    # merged groups are keyed by their first name so keys are stable
+    keys = {}
+    for name in sorted(DEVICE_GROUPS):
+        keys.setdefault(find(("group", name)), "group:" + name)
+    return {
+        owner: keys[find(owner)]
+        for owner in set(owners.values())
+        if find(owner) in keys
+    }
+
+
+class ReconnectScheduler:
+    """Central reconnect policy for devices and the MQTT bridge.
+
+    The first retry after a failure is immediate, later retries back off
+    exponentially with jitter so devices do not retry in lock step after an
+    outage.  A semaphore caps how many device reconnects run at once.
+    """
+
+    def __init__(
+        self,
+        base=DEVICE_RECONNECT_BASE_SECONDS,
+        maximum=DEVICE_RECONNECT_SECONDS,
+        concurrency=DEVICE_RECONNECT_CONCURRENCY,
+    ):
+        self.base = base
+        self.maximum = maximum
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        self.states = {}  # key -> {"attempts": ..., "last_error": ...}
+
+    def state(self, key):
+        with self.lock:
+            return self.states.setdefault(key, {"attempts": 0, "last_error": None})
+
+    def failed(self, key, error):
+        state = self.state(key)
+        state["attempts"] += 1
+        state["last_error"] = "{}".format(error)
+
+    def succeeded(self, key):
+        state = self.state(key)
+        state["attempts"] = 0
+        state["last_error"] = None
+
+    def delay(self, key, maximum=None):
+        attempts = self.state(key)["attempts"]
+        if attempts <= 1:
+            return 0
+        cap = min(maximum or self.maximum, self.base * 2 ** (attempts - 2))
+        # equal jitter, half fixed and half random
+        return cap / 2 + random.uniform(0, cap / 2)
+
+    @contextmanager
+    def slot(self):
+        with self.slots:
+            yield
+
+
+class PollingClient(mqtt.Client):
+    """paho client whose network loop waits with poll().
+
+    paho 1.6 waits with select(), which fails for descriptors above 1023 and
+    a process holding a connection per device soon has those.  This is
+    paho's _loop with the select() call replaced.
+    """
+
+    def _loop(self, timeout=1.0):
+        if timeout < 0.0:
+            raise ValueError("Invalid timeout.")
+        sock = self._sock
+        if sock is None:
+            return mqtt.MQTT_ERR_CONN_LOST
+
+        # used to check if there are any bytes left in the (SSL) socket
+        pending_bytes = 0
+        if hasattr(sock, "pending"):
+            pending_bytes = sock.pending()
+        if pending_bytes > 0:
+            timeout = 0.0
+
+        poller = select.poll()
+        try:
+            events = select.POLLIN
+            if self._out_packet:
+                events |= select.POLLOUT
+            poller.register(sock, events)
+            # sockpairR breaks out of the wait on a call to publish() etc.
+            if self._sockpairR is not None:
+                poller.register(self._sockpairR, select.POLLIN)
+            ready = dict(poller.poll(timeout * 1000))
+        except (TypeError, ValueError):
+            # socket isn't correct type, in likelihood connection is lost
+            return mqtt.MQTT_ERR_CONN_LOST
+        except Exception:
+            return mqtt.MQTT_ERR_UNKNOWN
+
+        sock_events = ready.get(sock.fileno(), 0)
+        if sock_events & ~select.POLLOUT or pending_bytes > 0:
+            rc = self.loop_read()
+            if rc or self._sock is None:
+                return rc
+
+        write = sock_events & select.POLLOUT
+        if self._sockpairR is not None and self._sockpairR.fileno() in ready:
+            # write even though no packet was queued when the wait began
+            write = True
+            try:
+                self._sockpairR.recv(10000)
+            except BlockingIOError:
+                pass
+
+        if write:
+            rc = self.loop_write()
+            if rc or self._sock is None:
+                return rc
+
+        return self.loop_misc()
+
+
+class MqttBridge:
+    """Single MQTT connection shared by all device monitors.
+
+    Publishes are multiplexed over one client and incoming homie set messages
+    are routed to the monitor owning the homie device id in the topic.  With
+    MQTT 5 data values are published with topic aliases, as many as the
+    broker grants, optional message expiry and a timestamp user property.
+    """
+
+    def __init__(
+        self,
+        reconnects,
+        client_id=MQTT_CLIENT_ID,
+        base_topic=MQTT_BRIDGE_TOPIC,
+        v5=MQTT_V5,
+        profiler=None,
+    ):
+        self.reconnects = reconnects
+        self.client_id = client_id
+        self.state_topic = "{}/{}".format(base_topic, "$state")
+        # a number of seconds published here starts a profile
+        self.profile_topic = "{}/{}".format(base_topic, "$profile/set")
+        self.profiler = profiler
+        self.monitors = {}  # homie device id -> DeviceMonitor
+        self.lock = threading.Lock()
+        self.connected = False
+        self.ready = threading.Event()
+
+        # topic aliases of the current connection
+        self.v5 = v5
+        self.alias_lock = threading.Lock()
+        self.aliases = {}  # topic -> alias
+        self.alias_topics = {}  # alias -> topic
+        self.alias_maximum = 0  # granted by the broker on connect
+
+        # mqtt client
+        if v5:
+            self.mqtt = PollingClient(client_id=client_id, protocol=mqtt.MQTTv5)
+        else:
+            self.mqtt = PollingClient(client_id=client_id)
+        self.mqtt.on_message = self.on_mqtt_message
         self.mqtt.on_connect = self.on_mqtt_connect
         self.mqtt.on_disconnect = self.on_mqtt_disconnect
 
-        # Not connected
-        self.tuya_connected = False
+        # MQTT Will for the bridge, devices reference it for availability
+        self.mqtt.will_set(
+            self.state_topic,
+            payload="lost",
+            qos=HOMIE_MQTT_QOS,
+            retain=HOMIE_MQTT_RETAIN,
+        )
 
-        # connect to MQTT
-        self.mqtt_connect(
-            host=MQTT_HOST,
-            port=MQTT_PORT,
-            username=MQTT_USERNAME,
-            password=MQTT_PASSWORD,
+    def set_topic(self, monitor):
+        return "{}/{}/{}/{}/{}/{}".format(
+            HOMIE_BASE_TOPIC, monitor.homie_device_id, "+", "+", "set", "#"
         )
 
-        # do homie init
-        self.do_homie_init = True
+    def register(self, monitor):
+        with self.lock:
+            self.monitors[monitor.homie_device_id] = monitor
+        if self.connected:
+            self.mqtt.subscribe(self.set_topic(monitor))
+
+    def unregister(self, monitor):
+        with self.lock:
+            if self.monitors.get(monitor.homie_device_id) is not monitor:
+                return
+            del self.monitors[monitor.homie_device_id]
+        if self.connected:
+            self.mqtt.unsubscribe(self.set_topic(monitor))
 
-    def on_mqtt_connect(self, client, userdata, flags, rc):
+    def on_mqtt_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
-            logger.info("{} connected to MQTT...".format(self.label))
-            self.mqtt.subscribe(
-                "{}/{}/{}/{}/{}/{}".format(
-                    HOMIE_BASE_TOPIC, self.homie_device_id, "+", "+", "set", "#"
-                )
-            )
-            self.do_homie_init = True
+            logger.info("Connected to MQTT...")
+            with self.alias_lock:
+                self.aliases = {}
+                self.alias_topics = {}
+                self.alias_maximum = getattr(properties, "TopicAliasMaximum", 0)
+            self.connected = True
+            self.ready.set()
+            self.publish(self.state_topic, "ready")
+            if self.profiler is not None:
+                self.mqtt.subscribe(self.profile_topic)
+            with self.lock:
+                monitors = list(self.monitors.values())
+            if monitors:
+                self.mqtt.subscribe([(self.set_topic(m), 0) for m in monitors])
+            for m in monitors:
+                m.mqtt_connected()
         else:
             logger.info("Connectetion to MQTT failed return code of {}.".format(rc))
 
-    def on_mqtt_disconnect(self, client, userdata, rc):
-        logger.error(
-            "MQTT was disconnected for {} with return code of {}".format(self.label, rc)
-        )
+    def on_mqtt_disconnect(self, client, userdata, rc, properties=None):
+        self.connected = False
+        self.ready.clear()
+        if self.v5:
+            self.reset_aliases()
+        logger.error("MQTT was disconnected with return code of {}".format(rc))
+
+    def reset_aliases(self):
+        # aliases only last for a connection, paho resends unacknowledged
+        # messages on the next one so they need their topics back
+        with self.alias_lock:
+            with self.mqtt._out_message_mutex:
+                for message in self.mqtt._out_messages.values():
+                    alias = getattr(message.properties, "TopicAlias", None)
+                    if alias is None:
+                        continue
+                    if not message.topic:
+                        message._topic = self.alias_topics[alias].encode()
+                    del message.properties.TopicAlias
+            self.aliases = {}
+            self.alias_topics = {}
+
+    def on_mqtt_message(self, client, userdata, message):
+        if message.topic == self.profile_topic:
+            self.profile_message(message)
+            return
+        topics = message.topic.split("/")
+        with self.lock:
+            monitor = self.monitors.get(topics[1]) if len(topics) > 1 else None
+        if monitor is None:
+            logger.error(
+                "No device for received MQTT message topic={}.".format(message.topic)
+            )
+            return
+        monitor.homie_message(client, userdata, message)
+
+    def profile_message(self, message):
+        m = message.payload.decode("utf-8").strip()
+        try:
+            seconds = float(m) if m else PROFILE_SECONDS
+        except ValueError:
+            logger.error("Invalid profile seconds {}.".format(m))
+            return
+        if self.profiler is not None and seconds > 0:
+            self.profiler.start(seconds)
 
-    def mqtt_connect(
+    def connect(
         self,
         host="localhost",
         port=1883,
@@ -115,624 +828,2815 @@ class DeviceMonitor:
         keepalive=60,
         bind_address="",
     ):
-        logger.info("{} connecting to mqtt...".format(self.label))
+        logger.info("Connecting to mqtt...")
         if username != None and password != None:
             self.mqtt.username_pw_set(username=username, password=password)
+        self.mqtt.reconnect_delay_set(min_delay=1, max_delay=MQTT_RECONNECT_SECONDS)
         error = True
         while error:
             try:
                 self.mqtt.connect(host, port, keepalive, bind_address)
                 error = False
+                self.reconnects.succeeded("mqtt")
             except Exception as e:
+                self.reconnects.failed("mqtt", e)
+                delay = self.reconnects.delay("mqtt", MQTT_RECONNECT_SECONDS)
                 logger.error(
-                    "{} could not connect to mqtt due to {}.".format(self.label, e)
+                    "Could not connect to mqtt due to {}, retrying in {:.1f}s.".format(
+                        e, delay
+                    )
                 )
                 error = True
-                time.sleep(5)
+                time.sleep(delay)
         self.mqtt.loop_start()
 
-    def homie_message(self, client, userdata, message):
-        m = str(message.payload.decode("utf-8"))
-        logger.info(
-            "Received MQTT message topic={}, message={}".format(message.topic, m)
+    def publish(self, topic, message):
+        self.mqtt.publish(
+            topic=topic, payload=message, qos=HOMIE_MQTT_QOS, retain=HOMIE_MQTT_RETAIN
         )
-        topics = message.topic.split("/")
-        node_topic = topics[2]
-        property_topic = topics[3]
-        if node_topic != "data":
-            logger.error(
-                "Invalid node topic {} in received MQTT message.".format(node_topic)
+
+    def publish_value(self, topic, message, expiry=None):
+        """Publish a data value, the bulk of all publishes."""
+        if not self.v5:
+            self.publish(topic, message)
+            return
+        properties = Properties(PacketTypes.PUBLISH)
+        if expiry:
+            properties.MessageExpiryInterval = expiry
+        if MQTT_TIMESTAMP_PROPERTY:
+            properties.UserProperty = (
+                MQTT_TIMESTAMP_PROPERTY,
+                "{:.3f}".format(time.time()),
             )
+        with self.alias_lock:
+            alias = self.aliases.get(topic)
+            if alias is not None:
+                # the broker knows the topic, send only its alias
+                properties.TopicAlias = alias
+                topic = ""
+            elif self.connected and len(self.aliases) < self.alias_maximum:
+                alias = len(self.aliases) + 1
+                self.aliases[topic] = alias
+                self.alias_topics[alias] = topic
+                properties.TopicAlias = alias
+            # published under the lock so an alias is never sent before
+            # the message that defines it
+            self.mqtt.publish(
+                topic=topic,
+                payload=message,
+                qos=HOMIE_MQTT_QOS,
+                retain=HOMIE_MQTT_RETAIN,
+                properties=properties,
+            )
+
+    def metric_samples(self):
+        # paho keeps no public counters, read the length of its queues
+        return [
+            ("tuya_mqtt_mqtt_connected", "", {}, int(self.connected)),
+            ("tuya_mqtt_mqtt_topic_aliases", "", {}, len(self.aliases)),
+            (
+                "tuya_mqtt_mqtt_queued",
+                "",
+                {},
+                len(getattr(self.mqtt, "_out_packet", ())),
+            ),
+            (
+                "tuya_mqtt_mqtt_inflight",
+                "",
+                {},
+                len(getattr(self.mqtt, "_out_messages", ())),
+            ),
+        ]
+
+
+class DeviceAddressCache:
+    """Device id -> last known ip address, persisted between runs.
+
+    Addresses are resolved for all devices with one discovery pass at startup
+    so monitors can connect directly instead of each scanning the network.
+    """
 
-        # get data node
-        if "__nodes__" in self.homie_device_info:
-            n = next(
-                n
-                for n in self.homie_device_info["__nodes__"]
-                if n["__topic__"] == "data"
+    def __init__(self, filename=DEVICE_ADDRESS_CACHE_FILE):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.addresses = {}  # device id -> {"ip": ..., "version": ...}
+        self.changed = set()  # device ids to write on the next save
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                self.addresses = json.load(f)
+            logger.info(
+                "Loaded {} cached device addresses.".format(len(self.addresses))
             )
-        else:
+        except FileNotFoundError:
+            self.addresses = {}
+        except Exception as e:
             logger.error(
-                "Message on topic {} ignored as we have no nodes for {} (Probably not connected).".format(
-                    message.topic, self.label
+                "Could not load device address cache {} due to {}.".format(
+                    self.filename, e
                 )
             )
-            return
-
-        properties = filter(
-            lambda p: property_topic == p["__topic__"], n["__properties__"]
-        )
+            self.addresses = {}
 
-        for p in properties:
-            if p["$settable"] == "true" or p["$settable"] == True:
-                v = None
-                if p["$datatype"] == "boolean":
-                    if m in ["true", "True", "TRUE"]:
-                        v = True
-                    elif m in ["false", "False", "FALSE"]:
-                        v = False
-                    else:
-                        v = None
-                        logger.error("Invalid message {} for boolean type.".format(m))
-                elif p["$datatype"] in ("enum", "string"):
-                    v = str(m)
-                elif p["$datatype"] == "integer":
-                    try:
-                        v = int(m)
-                    except:
-                        v = None
-                        logger.error("Invalid message {} for integer type.".format(m))
-                elif p["$datatype"] == "float":
-                    try:
-                        v = float(m)
-                    except:
-                        v = None
-                        logger.error("Invalid message {} for float type.".format(m))
-                if v != None:
-                    self.device.set_value(p["__tuya_code__"], v)
-                    logger.info(
-                        "Set tuya code {} to value {} for {}.".format(
-                            p["__tuya_code__"], v, self.label
-                        )
-                    )
-            else:
-                logger.error(
-                    "Property topic {} in received MQTT message settable state is {}.".format(
-                        property_topic, p["$settable"]
-                    )
+    def save(self):
+        with self.lock:
+            changed = {dev_id: self.addresses[dev_id] for dev_id in self.changed}
+            self.changed.clear()
+        try:
+            with open(self.filename + ".lock", "w") as lock:
+                # worker processes share the file so merge under a file lock
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(self.filename) as f:
+                        addresses = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    addresses = {}
+                addresses.update(changed)
+                tmp_filename = self.filename + ".tmp"
+                with open(tmp_filename, "w") as f:
+                    json.dump(addresses, f, indent=2)
+                os.replace(tmp_filename, self.filename)
+        except Exception as e:
+            logger.error(
+                "Could not save device address cache {} due to {}.".format(
+                    self.filename, e
                 )
+            )
 
-    def homie_publish(self, topic, message):
-        self.mqtt.publish(
-            topic=topic, payload=message, qos=HOMIE_MQTT_QOS, retain=HOMIE_MQTT_RETAIN
-        )
+    def get(self, dev_id):
+        with self.lock:
+            entry = self.addresses.get(dev_id)
+        return entry["ip"] if entry else None
 
-    def create_device_info_nodes(self):
-        nodes = [
-            {
-                "__topic__": "deviceinfo",
-                "$name": "Device info",
-                "$properties": "",
-                "__properties__": [
-                    {
-                        "__topic__": "id",
-                        "__tuya_code__": "id",
-                        "$name": "Tuya Device ID",
-                        "$datatype": "string",
-                        "$retained": "true",
-                        "$settable": "false",
-                    },
-                    {
-                        "__topic__": "mac",
-                        "__tuya_code__": "mac",
-                        "$name": "Device MAC",
-                        "$datatype": "string",
-                        "$retained": "true",
-                        "$settable": "false",
-                    },
-                    {
-                        "__topic__": "uuid",
-                        "__tuya_code__": "uuid",
-                        "$name": "UUID",
-                        "$datatype": "string",
-                        "$retained": "true",
-                        "$settable": "false",
-                    },
-                    {
-                        "__topic__": "sn",
-                        "__tuya_code__": "sn",
-                        "$name": "Serial Number",
-                        "$datatype": "string",
-                        "$retained": "true",
-                        "$settable": "false",
-                    },
-                    {
-                        "__topic__": "sub",
-                        "__tuya_code__": "sub",
-                        "$name": "Sub Device",
-                        "$datatype": "boolean",
-                        "$retained": "true",
-                        "$settable": "false",
-                    },
-                    {
-                        "__topic__": "icon",
-                        "__tuya_code__": "icon",
-                        "$name": "Icon URL",
-                        "$datatype": "string",
-                        "$retained": "true",
-                        "$settable": "false",
-                    },
-                    # this is ip at time devices file was created and may not be current
-                    # {
-                    #     "__topic__": "ip",
-                    #     "__tuya_code__": "ip",
-                    #     "$name": "Device IP",
-                    #     "$datatype": "string",
-                    #     "$retained" : "true",
-                    #     "$settable": "false"
-                    # },
-                    {
-                        "__topic__": "version",
-                        "__tuya_code__": "version",
-                        "$name": "Tuya Version",
-                        "$datatype": "string",
-                        "$retained": "true",
-                        "$settable": "false",
-                    },
-                ],
-            },
-            {
-                "__topic__": "productinfo",
-                "$name": "Product info",
-                "$properties": "",
-                "__properties__": [
-                    {
-                        "__topic__": "category",
-                        "__tuya_code__": "category",
-                        "$name": "Category",
-                        "$datatype": "string",
-                        "$retained": "true",
-                        "$settable": "false",
-                    },
-                    {
-                        "__topic__": "productname",
-                        "__tuya_code__": "product_name",
-                        "$name": "Product Name",
-                        "$datatype": "string",
-                        "$retained": "true",
-                        "$settable": "false",
-                    },
-                    {
-                        "__topic__": "productid",
-                        "__tuya_code__": "product_id",
-                        "$name": "Product ID",
-                        "$datatype": "string",
-                        "$retained": "true",
-                        "$settable": "false",
-                    },
-                    {
-                        "__topic__": "biztype",
-                        "__tuya_code__": "biz_type",
-                        "$name": "Biz Type",
-                        "$datatype": "integer",
-                        "$retained": "true",
-                        "$settable": "false",
-                    },
-                ],
-            },
+    def set(self, dev_id, ip, version=None, save=True):
+        with self.lock:
+            entry = {"ip": ip, "version": version}
+            if self.addresses.get(dev_id) == entry:
+                return
+            self.addresses[dev_id] = entry
+            self.changed.add(dev_id)
+        if save:
+            self.save()
+
+    def discover(self, devices_info):
+        """Resolve all devices missing from the cache with one network scan."""
+        missing = [
+            di["id"]
+            for di in devices_info
+            if device_gateway_id(di) is None and self.get(di["id"]) is None
         ]
-        return nodes
+        if missing:
+            from tinytuya import scanner
 
-    def update_device_nodes_properties(self):
-        self.homie_device_info["$nodes"] = ""
-        for i, n in enumerate(self.homie_device_info["__nodes__"]):
-            if self.homie_device_info["$nodes"] == "":
-                self.homie_device_info["$nodes"] = n["__topic__"]
-            else:
-                self.homie_device_info["$nodes"] = (
-                    self.homie_device_info["$nodes"] + "," + n["__topic__"]
-                )
-            self.homie_device_info["__nodes__"][i]["$properties"] == ""
-            for p in n["__properties__"]:
-                if self.homie_device_info["__nodes__"][i]["$properties"] == "":
-                    self.homie_device_info["__nodes__"][i]["$properties"] = p[
-                        "__topic__"
-                    ]
-                else:
-                    self.homie_device_info["__nodes__"][i]["$properties"] = (
-                        self.homie_device_info["__nodes__"][i]["$properties"]
-                        + ","
-                        + p["__topic__"]
-                    )
+            logger.info("Discovering {} devices on the network...".format(len(missing)))
+            try:
+                found = scanner.devices(
+                    verbose=False,
+                    scantime=DEVICE_DISCOVERY_SECONDS,
+                    poll=False,
+                    byID=True,
+                    wantids=missing,
+                )
+            except Exception as e:
+                logger.error("Device discovery failed due to {}.".format(e))
+                found = {}
+            for dev_id, result in found.items():
+                if dev_id in missing and result.get("ip"):
+                    self.set(dev_id, result["ip"], result.get("version"), save=False)
+        for di in devices_info:
+            # fall back to the ip recorded when the device file was created
+            if self.get(di["id"]) is None and di.get("ip"):
+                self.set(di["id"], di["ip"], di.get("version"), save=False)
+        self.save()
 
-    def create_data_node(self):
-        data_node = {
-            "__topic__": "data",
-            "$name": "Data",
-            "$properties": "",
-            "__properties__": [],
-        }
-        for dp in self.status["dps_objects"]:
-            if dp.value_type == "bitmap":
-                for b in dp.bitmap:
-                    p = {
-                        "__topic__": format_homie_id(dp.name + b),
-                        "__tuya_code__": dp.name,
-                        "__tuya_bitmap_value__": b,
-                        "$name": dp.name + " " + b,
-                        "$settable": "false",  # cannot set bitmaps here
-                        "$datatype": "boolean",
-                    }
-                    data_node["__properties__"].append(p)
-            else:
-                append_property = True
-                p = {
-                    "__topic__": format_homie_id(dp.name),
-                    "__tuya_code__": dp.name,
-                    "$name": dp.name,
-                    "$settable": str(dp.settable).lower(),
-                }
-                if dp.value_type == "integer":
-                    if dp.int_step < 1:
-                        p["$datatype"] = "float"
-                    else:
-                        p["$datatype"] = "integer"
-                    p["$format"] = "{}:{}".format(dp.int_min, dp.int_max)
-                    if dp.unit:
-                        if dp.unit == "Kw·h":
-                            p["$unit"] = "kWh"
-                        elif dp.unit == "hour":
-                            p["$unit"] = "h"
-                        else:
-                            p["$unit"] = dp.unit
-                elif dp.value_type == "enum":
-                    p["$datatype"] = dp.value_type
-                    p["$format"] = ""
-                    for e in dp.enum_range:
-                        if p["$format"] == "":
-                            p["$format"] = "{}".format(e)
-                        else:
-                            p["$format"] = "{},{}".format(p["$format"], e)
-                elif dp.value_type in ["string", "boolean"]:
-                    p["$datatype"] = dp.value_type
-                else:
-                    append_property == False
-                    logger.error("Unknown value type {}".format(dp.value_type))
-                if append_property:
-                    data_node["__properties__"].append(p)
-        self.homie_device_info["__nodes__"].append(data_node)
+    def rescan(self, dev_id):
+        """Scan for a single device whose cached address failed."""
+        logger.info("Scanning network for device {}...".format(dev_id))
+        result = tinytuya.find_device(dev_id=dev_id)
+        if result and result.get("ip"):
+            self.set(dev_id, result["ip"], result.get("version"))
+            return result["ip"]
+        return None
 
-    def create_homie_device_info(self):
-        self.homie_device_info = {
-            "$homie": HOMIE_DEVICE_VERSION,
-            "$name": self.name,
-            "$nodes": "",
-            # "$extensions": "",
-            "$implementation": HOMIE_IMPLEMENTATION,
-            "__nodes__": [],
-        }
-        if HOMIE_PUBLISH_DEVICE_INFO:
-            self.homie_device_info["__nodes__"] = self.create_device_info_nodes()
 
-        self.create_data_node()
-        self.update_device_nodes_properties()
+class DeviceAnnouncementListener:
+    """Passive listener for the UDP broadcasts Tuya devices send.
 
-    def get_hass_config_template(self):
-        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, self.homie_device_id, "$state")
-        config_template = {
-            "availability": {
-                "topic": topic,
-                "payload_available": "ready",
-                "payload_not_available": "lost",
-            },
-            "availability_mode": "latest",
-            "device": {
-                "identifiers": [self.device_info["sn"], self.id, self.homie_device_id],
-                "model": self.device_info["product_name"],
-                "name": self.name,
-                "sw_version": self.version,
-                "via_device": MQTT_CLIENT_ID,
-            },
-        }
-        return config_template
+    Keeps a live device id -> ip/version table for the whole process and
+    tells the owning monitor as soon as a device announces a new address.
+    """
 
-    def hass_publish_configs(self):
-        for n in self.homie_device_info["__nodes__"]:
-            for p in n["__properties__"]:
-                component = "Unknown"
-                unique_id = (
-                    self.homie_device_id + "_" + n["__topic__"] + "_" + p["__topic__"]
-                )
-                config = self.get_hass_config_template()
-                config["name"] = p["$name"]
-                config["state_topic"] = "{}/{}/{}/{}".format(
-                    HOMIE_BASE_TOPIC,
-                    self.homie_device_id,
-                    n["__topic__"],
-                    p["__topic__"],
-                )
-                command_topic = "{}/{}/{}/{}/{}".format(
-                    HOMIE_BASE_TOPIC,
-                    self.homie_device_id,
-                    n["__topic__"],
-                    p["__topic__"],
-                    "set",
-                )
-
-                config["unique_id"] = unique_id
-                if p["$datatype"] == "boolean":
-                    config["payload_off"] = "false"
-                    config["payload_on"] = "true"
-                    if p["$settable"] == "true":
-                        component = "switch"
-                        config["optimistic"] = False
-                        config["command_topic"] = command_topic
-                    else:
-                        component = "binary_sensor"
-                elif p["$datatype"] in ("float", "integer"):
-                    if "$unit" in p:
-                        config["unit_of_measurement"] = p["$unit"]
-                    if p["$settable"] == "true":
-                        component = "number"
-                        config["optimistic"] = False
-                        config["command_topic"] = command_topic
-                        if "$format" in p:
-                            config["min"], config["max"] = p["$format"].split(":")
-                    else:
-                        component = "sensor"
-                elif p["$datatype"] == "string":
-                    if p["$settable"] == "true":
-                        component = "text"
-                        config["optimistic"] = False
-                        config["command_topic"] = command_topic
-                    else:
-                        component = "sensor"
-                elif p["$datatype"] == "enum":
-                    options = p["$format"].split(",")
-                    if len(options) == 2 and "On" in options and "Off" in options:
-                        config["payload_off"] = "Off"
-                        config["payload_on"] = "On"
-                        if p["$settable"] == "true":
-                            component = "switch"
-                            config["optimistic"] = False
-                            config["command_topic"] = command_topic
-                        else:
-                            component = "binary_sensor"
-                    else:
-                        if p["$settable"] == "true":
-                            component = "select"
-                            config["optimistic"] = False
-                            config["command_topic"] = command_topic
-                            config["options"] = p["$format"].split(",")
-                        else:
-                            component = "sensor"
-                else:
-                    logger.error(
-                        "Could not represent property {} of node {} for {}.".format(
-                            p["__topic__"], n["__topic__"], self.label
-                        )
-                    )
+    def __init__(self, addresses, ports=(tinytuya.UDPPORT, tinytuya.UDPPORTS)):
+        self.addresses = addresses
+        self.ports = ports
+        self.devices = {}  # device id -> {"ip": ..., "version": ...}
+        self.monitors = {}  # device id -> DeviceMonitor
+        self.lock = threading.Lock()
+        self.sockets = []
 
-                topic = "{}/{}/{}/{}".format(
-                    HASS_BASE_TOPIC,
-                    component,
-                    unique_id,
-                    "config",
-                )
-                config_serialised = json.dumps(config)
-                if component != "Unknown":
-                    # pprint(config_serialised)
-                    self.homie_publish(topic, config_serialised)
-                else:
-                    pprint(p)
+    def register(self, monitor):
+        with self.lock:
+            self.monitors[monitor.id] = monitor
 
-    def homie_publish_device_state(self, state):
-        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, self.homie_device_id, "$state")
-        self.homie_publish(topic, state)
+    def unregister(self, monitor):
+        with self.lock:
+            if self.monitors.get(monitor.id) is monitor:
+                del self.monitors[monitor.id]
 
-    def homie_init_device(self):
-        for k in self.homie_device_info:
-            if k != "__nodes__":
-                topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, self.homie_device_id, k)
-                self.homie_publish(topic, self.homie_device_info[k])
-        for n in self.homie_device_info["__nodes__"]:
-            for k in n:
-                if k not in ["__topic__", "__properties__"]:
-                    topic = "{}/{}/{}/{}".format(
-                        HOMIE_BASE_TOPIC, self.homie_device_id, n["__topic__"], k
-                    )
-                    self.homie_publish(topic, n[k])
-            for p in n["__properties__"]:
-                for k in p:
-                    if k not in ["__topic__", "__tuya_code__", "__tuya_bitmap_value__"]:
-                        topic = "{}/{}/{}/{}/{}".format(
-                            HOMIE_BASE_TOPIC,
-                            self.homie_device_id,
-                            n["__topic__"],
-                            p["__topic__"],
-                            k,
-                        )
-                        self.homie_publish(topic, p[k])
+    def get(self, dev_id):
+        with self.lock:
+            entry = self.devices.get(dev_id)
+        return entry["ip"] if entry else None
 
-    def homie_publish_device_info(self):
-        nodes = filter(
-            lambda node: node["__topic__"] in ["deviceinfo", "productinfo"],
-            self.homie_device_info["__nodes__"],
-        )
-        for n in nodes:
-            for p in n["__properties__"]:
-                if p["__tuya_code__"] in self.device_info:
-                    topic = "{}/{}/{}/{}".format(
-                        HOMIE_BASE_TOPIC,
-                        self.homie_device_id,
-                        n["__topic__"],
-                        p["__topic__"],
+    def start(self):
+        for port in self.ports:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if hasattr(socket, "SO_REUSEPORT"):
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                sock.bind(("", port))
+                self.sockets.append(sock)
+            except Exception as e:
+                logger.error(
+                    "Could not listen for device broadcasts on port {} due to {}.".format(
+                        port, e
                     )
-                    if p["$datatype"] == "boolean":
-                        self.homie_publish(
-                            topic, str(self.device_info[p["__tuya_code__"]]).lower()
-                        )
-                    else:
-                        self.homie_publish(topic, self.device_info[p["__tuya_code__"]])
+                )
+        if self.sockets:
+            logger.info("Listening for device broadcasts on {}...".format(self.ports))
+            threading.Thread(
+                target=self.run, name="announcement_listener", daemon=True
+            ).start()
 
-    def homie_publish_dps_objects(self, dps_objects):
-        n = next(
-            n for n in self.homie_device_info["__nodes__"] if n["__topic__"] == "data"
+    def run(self):
+        poller = select.poll()
+        sockets = {}  # fd -> socket
+        for sock in self.sockets:
+            poller.register(sock, select.POLLIN)
+            sockets[sock.fileno()] = sock
+        while True:
+            for fd, _ in poller.poll():
+                sock = sockets[fd]
+                try:
+                    data, addr = sock.recvfrom(4048)
+                    self.handle(self.decode(data), addr[0])
+                except Exception as e:
+                    logger.debug("Ignoring device broadcast due to {}.".format(e))
+
+    def decode(self, data):
+        try:
+            result = tinytuya.decrypt_udp(data)
+        except Exception:
+            result = data.decode()
+        return json.loads(result)
+
+    def handle(self, announcement, sender_ip):
+        dev_id = announcement.get("gwId")
+        if not dev_id:
+            return
+        ip = announcement.get("ip", sender_ip)
+        entry = {"ip": ip, "version": announcement.get("version")}
+        with self.lock:
+            previous = self.devices.get(dev_id)
+            self.devices[dev_id] = entry
+            monitor = self.monitors.get(dev_id)
+        if previous == entry:
+            return
+        cached_ip = self.addresses.get(dev_id)
+        self.addresses.set(dev_id, ip, entry["version"])
+        if monitor is not None and cached_ip is not None and cached_ip != ip:
+            logger.info(
+                "{} announced a new address {} (was {}).".format(
+                    monitor.label, ip, cached_ip
+                )
+            )
+            monitor.tuya_address_changed()
+
+
+class DeviceTimers:
+    """Heap of heartbeat, poll, re-init and dead-device deadlines.
+
+    A single thread serves the deadlines of every device using the monotonic
+    clock.  A due timer only marks the action on its monitor and wakes the
+    monitor's I/O owner, which performs it and schedules the next one.
+    """
+
+    def __init__(self):
+        self.heap = []  # (deadline, sequence, monitor, kind, generation)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def schedule(self, monitor, kind, delay):
+        deadline = time.monotonic() + delay
+        entry = (deadline, next(self.sequence), monitor, kind, monitor.timer_generation)
+        with self.condition:
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                self.condition.notify()
+
+    def start(self):
+        threading.Thread(target=self.run, name="device_timers", daemon=True).start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                wait = self.heap[0][0] - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                _, _, monitor, kind, generation = heapq.heappop(self.heap)
+            try:
+                monitor.timer_due(kind, generation)
+            except Exception:
+                # one failing monitor must not stop the timers of all others
+                logger.exception("Timer {} of {} failed.".format(kind, monitor.label))
+
+
+class DeviceMonitor:
+    def __init__(
+        self,
+        device_info,
+        bridge,
+        addresses,
+        reconnects,
+        timers,
+        listener=None,
+        gateway=None,
+    ):
+        self.id = device_info["id"]
+        self.homie_device_id = self.id
+        self.key = device_info["key"]
+        self.name = device_info["name"]
+        self.label = device_info["name"]  # + "(" + device_info['id'] + ")"
+        self.version = float(device_info.get("version") or 0)
+        self.device_info = device_info
+        self.homie_device_id = format_homie_id(self.name)
+        self.homie_device_info = None  # HomieDevice
+        self.homie_value_index = {}
+        self.homie_set_index = {}
+        self.homie_filters = {}
+        self.homie_aggregates = {}
+        self.homie_aggregate_topics = {}
+        self.homie_expiry = {}  # topic -> MQTT 5 message expiry seconds
+        self.homie_full_refresh_time = float("-inf")
+        self.homie_value_cache = {}  # topic -> last published payload
+        self.homie_republish = False  # set when the broker reconnected
+        self.homie_attributes = {}  # topic -> last published description
+        self.homie_staged_attributes = {}
+        self.homie_fingerprint = None
+        self.homie_snapshot_dps = []
+        self.homie_from_snapshot = False  # state ready published from a snapshot
+        self.publish_cache_hits = 0
+        self.publish_cache_misses = 0
+        self.tuya_last_data_time = time.monotonic()
+
+        # metrics, only updated by the I/O owner
+        self.status_latency = Histogram()
+        self.receive_latency = Histogram()
+        self.messages_received = 0
+        self.messages_published = 0
+        self.connects = 0
+        self.connect_failures = 0
+
+        logger.info("Initialising device instance for {}...".format(self.label))
+
+        # Not connected
+        self.tuya_connected = False
+        self.homie_state = None
+
+        # do homie init
+        self.do_homie_init = True
+        self.startup = None  # StartupScheduler until the first homie init
+
+        # stopped by the device registry when removed or changed
+        self.stopped = False
+        self.remove = False
+        self.finished = threading.Event()
+        self.device = None
+
+        # sub devices reached through this device's connection
+        self.gateway = gateway
+        self.children = {}  # device id -> SubDeviceMonitor
+
+        # shared mqtt connection, registered once initialised
+        self.bridge = bridge
+
+        # shared reconnect backoff
+        self.reconnects = reconnects
+        self.tuya_last_error = None
+
+        # shared address cache, rescan only after the cached address failed
+        # DEVICE_RESCAN_FAILURES times in a row
+        self.addresses = addresses
+        self.address = None
+        self.address_failures = 0
+        self.address_changed = False
+
+        # broadcast listener reports address changes
+        self.listener = listener
+        if listener is not None:
+            listener.register(self)
+
+        # deadlines served by the shared timer heap
+        self.timers = timers
+        self.timer_generation = 0
+        self.due = set()
+        self.poll_seconds = DEVICE_POLL_SECONDS.get(
+            self.id,
+            DEVICE_POLL_SECONDS.get(
+                device_info.get("product_id"), HOMIE_PUBLISH_ALL_SECONDS
+            ),
+        )
+
+        # other threads wake the device I/O owner (commands, timers, addresses)
+        # created by the thread engine's loop, the asyncio engine uses an event
+        self.wakeup_r = None
+        self.wakeup_w = None
+        self.event_loop = None
+        self.async_wakeup_event = None
+        self.async_waiter = None
+
+        # set commands waiting for the I/O owner, tuya code -> value
+        self.command_lock = threading.Lock()
+        self.pending_commands = {}
+        self.pending_commands_time = 0
+        # tuya code -> [callback(monitor, error)] for queued and sent commands
+        self.command_callbacks = {}
+        self.confirmation_callbacks = {}
+
+        # sent commands waiting for the device to confirm, tuya code -> (value, time)
+        self.pending_confirmations = {}
+        self.command_latency = {}  # tuya code -> round trip statistics
+
+        self.bridge.register(self)
+
+    def homie_message(self, client, userdata, message):
+        m = str(message.payload.decode("utf-8"))
+        logger.info(
+            "Received MQTT message topic={}, message={}".format(message.topic, m)
+        )
+        topics = message.topic.split("/")
+        node_topic = topics[2]
+        property_topic = topics[3]
+        if node_topic != "data":
+            logger.error(
+                "Invalid node topic {} in received MQTT message.".format(node_topic)
+            )
+            return
+
+        if not self.homie_set_index:
+            logger.error(
+                "Message on topic {} ignored as we have no nodes for {} (Probably not connected).".format(
+                    message.topic, self.label
+                )
+            )
+            return
+
+        entry = self.homie_set_index.get(property_topic)
+        if entry is None:
+            logger.error(
+                "Unknown property topic {} in received MQTT message.".format(
+                    property_topic
+                )
+            )
+            return
+
+        tuya_code, datatype, settable = entry
+        if not settable:
+            logger.error(
+                "Property topic {} in received MQTT message settable state is {}.".format(
+                    property_topic, settable
+                )
+            )
+            return
+
+        try:
+            v = HOMIE_PARSERS[datatype](m)
+        except (KeyError, ValueError):
+            logger.error("Invalid message {} for {} type.".format(m, datatype))
+            return
+        if not self.tuya_connected:
+            logger.error(
+                "Set of tuya code {} ignored as {} is not connected.".format(
+                    tuya_code, self.label
+                )
+            )
+            return
+        # sent by the device I/O owner, never from the mqtt thread
+        self.tuya_queue_command(tuya_code, v)
+
+    def homie_publish(self, topic, message):
+        self.messages_published += 1
+        self.bridge.publish(topic, message)
+
+    def homie_publish_data(self, topic, message):
+        self.messages_published += 1
+        self.bridge.publish_value(topic, message, self.homie_expiry.get(topic))
+
+    def create_device_info_nodes(self):
+        return list(DEVICE_INFO_NODES)
+
+    def create_data_node(self):
+        # devices of a product share the property descriptors
+        dps_objects = self.status["dps_objects"]
+        key = (
+            self.device_info.get("product_id"),
+            self.id if self.id in HOMIE_AGGREGATES else None,
+            dp_schema_key(dps_objects),
         )
+        properties = SCHEMA_CACHE.get(key)
+        if properties is None:
+            properties = SCHEMA_CACHE[key] = self.create_data_properties(dps_objects)
+        self.homie_device_info.nodes.append(HomieNode("data", "Data", properties))
+
+    def create_data_properties(self, dps_objects):
+        properties = []
         for dp in dps_objects:
             if dp.value_type == "bitmap":
                 for b in dp.bitmap:
-                    properties = filter(
-                        lambda p: dp.name == p["__tuya_code__"]
-                        and b == p["__tuya_bitmap_value__"],
-                        n["__properties__"],
-                    )
-                    for p in properties:
-                        topic = "{}/{}/{}/{}".format(
-                            HOMIE_BASE_TOPIC,
-                            self.homie_device_id,
-                            n["__topic__"],
-                            p["__topic__"],
+                    properties.append(
+                        HomieProperty(
+                            format_homie_id(dp.name + b),
+                            dp.name,
+                            dp.name + " " + b,
+                            "boolean",
+                            settable=False,  # cannot set bitmaps here
+                            bitmap_value=b,
                         )
-                    self.homie_publish(topic, ("{}".format(b in dp.value)).lower())
+                    )
+            elif dp.value_type == "integer":
+                unit = dp.unit or None
+                if unit == "Kw·h":
+                    unit = "kWh"
+                elif unit == "hour":
+                    unit = "h"
+                p = HomieProperty(
+                    format_homie_id(dp.name),
+                    dp.name,
+                    dp.name,
+                    "float" if dp.int_step < 1 else "integer",
+                    settable=bool(dp.settable),
+                    format="{}:{}".format(dp.int_min, dp.int_max),
+                    unit=unit,
+                )
+                properties.append(p)
+                properties.extend(self.create_aggregate_properties(p))
+            elif dp.value_type in ["enum", "string", "boolean"]:
+                properties.append(
+                    HomieProperty(
+                        format_homie_id(dp.name),
+                        dp.name,
+                        dp.name,
+                        dp.value_type,
+                        settable=bool(dp.settable),
+                        format=(
+                            ",".join("{}".format(e) for e in dp.enum_range)
+                            if dp.value_type == "enum"
+                            else None
+                        ),
+                    )
+                )
             else:
-                properties = filter(
-                    lambda p: dp.name == p["__tuya_code__"], n["__properties__"]
+                logger.error("Unknown value type {}".format(dp.value_type))
+        return tuple(properties)
+
+    def create_aggregate_properties(self, p):
+        properties = []
+        aggregates = dp_setting(HOMIE_AGGREGATES, self.device_info, p.tuya_code)
+        for function, seconds in aggregates or []:
+            suffix = "{}_{}s".format(function, seconds)
+            properties.append(
+                HomieProperty(
+                    format_homie_id(p.tuya_code + suffix),
+                    p.tuya_code,
+                    "{} {} {}s".format(p.name, function, seconds),
+                    "float",
+                    unit=p.unit,
+                    aggregate=(function, seconds),
+                )
+            )
+        return properties
+
+    def create_homie_device_info(self):
+        nodes = []
+        if HOMIE_PUBLISH_DEVICE_INFO:
+            nodes = self.create_device_info_nodes()
+        self.homie_device_info = HomieDevice(self.name, nodes)
+        self.create_data_node()
+        self.create_homie_indexes()
+
+    def create_homie_indexes(self):
+        # hash indexes so the publish and set paths need no scans or formatting
+        value_index = {}  # (tuya code, bitmap value) -> (topic, encoder, filter)
+        set_index = {}  # property topic -> (tuya code, datatype, settable)
+        filters = {}  # property topic -> PublishFilter
+        aggregates = {}  # tuya code -> [(topic, Aggregate)]
+        expiry = {}  # property topic -> message expiry seconds
+        for n in self.homie_device_info.nodes:
+            if n.topic != "data":
+                continue
+            for p in n.properties:
+                topic = "{}/{}/{}/{}".format(
+                    HOMIE_BASE_TOPIC, self.homie_device_id, n.topic, p.topic
+                )
+                seconds = dp_setting(MQTT_MESSAGE_EXPIRY, self.device_info, p.tuya_code)
+                if seconds:
+                    expiry[topic] = seconds
+                if p.aggregate is not None:
+                    # keep running windows across re-inits
+                    aggregate = self.homie_aggregate_topics.get(topic) or Aggregate(
+                        *p.aggregate
+                    )
+                    aggregates.setdefault(p.tuya_code, []).append((topic, aggregate))
+                    continue
+                bitmap_value = p.bitmap_value
+                if bitmap_value is not None:
+                    encoder = bitmap_encoder(bitmap_value)
+                elif p.datatype == "boolean":
+                    encoder = encode_boolean
+                else:
+                    encoder = encode_value
+                settings = dp_setting(
+                    HOMIE_PUBLISH_FILTERS, self.device_info, p.tuya_code
+                )
+                if settings:
+                    # keep the state of filters across re-inits
+                    filters[topic] = self.homie_filters.get(topic) or PublishFilter(
+                        **settings
+                    )
+                value_index[(p.tuya_code, bitmap_value)] = (
+                    topic,
+                    encoder,
+                    filters.get(topic),
                 )
-                for p in properties:
+                set_index[p.topic] = (p.tuya_code, p.datatype, p.settable)
+        self.homie_value_index = value_index
+        self.homie_set_index = set_index
+        self.homie_filters = filters
+        self.homie_aggregates = aggregates
+        self.homie_expiry = expiry
+        self.homie_aggregate_topics = {
+            topic: aggregate
+            for code_aggregates in aggregates.values()
+            for topic, aggregate in code_aggregates
+        }
+
+    def get_hass_config_template(self):
+        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, self.homie_device_id, "$state")
+        config_template = {
+            "availability": [
+                {
+                    "topic": topic,
+                    "payload_available": "ready",
+                    "payload_not_available": "lost",
+                },
+                {
+                    "topic": self.bridge.state_topic,
+                    "payload_available": "ready",
+                    "payload_not_available": "lost",
+                },
+            ],
+            "availability_mode": "all",
+            "device": {
+                "identifiers": [self.device_info["sn"], self.id, self.homie_device_id],
+                "model": self.device_info["product_name"],
+                "name": self.name,
+                "sw_version": self.version,
+                "via_device": MQTT_CLIENT_ID,
+            },
+        }
+        return config_template
+
+    def hass_publish_configs(self):
+        # device parts are serialised once, property parts once per schema
+        common = json.dumps(self.get_hass_config_template())[1:-1]
+        for topic, message in hass_configs(
+            self.homie_device_id, self.homie_device_info.nodes, common, self.label
+        ):
+            self.homie_stage_attribute(topic, message)
+
+    def homie_publish_device_state(self, state):
+        topic = "{}/{}/{}".format(HOMIE_BASE_TOPIC, self.homie_device_id, "$state")
+        self.homie_publish(topic, state)
+        self.homie_state = state
+
+    def homie_stage_attribute(self, topic, message):
+        self.homie_staged_attributes[topic] = message
+
+    def homie_init_device(self):
+        for topic, message in homie_attributes(
+            self.homie_device_id, self.homie_device_info
+        ):
+            self.homie_stage_attribute(topic, message)
+
+    def homie_publish_device_info(self):
+        nodes = filter(
+            lambda node: node.topic in ["deviceinfo", "productinfo"],
+            self.homie_device_info.nodes,
+        )
+        for n in nodes:
+            for p in n.properties:
+                if p.tuya_code in self.device_info:
                     topic = "{}/{}/{}/{}".format(
-                        HOMIE_BASE_TOPIC,
-                        self.homie_device_id,
-                        n["__topic__"],
-                        p["__topic__"],
+                        HOMIE_BASE_TOPIC, self.homie_device_id, n.topic, p.topic
                     )
-                    if dp.value_type == "boolean":
-                        self.homie_publish(topic, ("{}".format(dp.value)).lower())
+                    if p.datatype == "boolean":
+                        self.homie_stage_attribute(
+                            topic, str(self.device_info[p.tuya_code]).lower()
+                        )
                     else:
-                        self.homie_publish(topic, "{}".format(dp.value))
+                        self.homie_stage_attribute(topic, self.device_info[p.tuya_code])
+
+    def homie_publish_value(self, topic, message):
+        # only publish values that changed since the last publish
+        if self.homie_value_cache.get(topic) == message:
+            self.publish_cache_hits += 1
+            return
+        self.publish_cache_misses += 1
+        self.homie_value_cache[topic] = message
+        self.homie_publish_data(topic, message)
+
+    def homie_full_refresh_if_due(self):
+        if time.monotonic() > self.homie_full_refresh_time + HOMIE_FULL_REFRESH_SECONDS:
+            logger.info(
+                "Full refresh for {} (publish cache hits={}, misses={}).".format(
+                    self.label, self.publish_cache_hits, self.publish_cache_misses
+                )
+            )
+            self.homie_save_snapshot()
+            self.homie_forget_values()
+            self.homie_full_refresh_time = time.monotonic()
+
+    def homie_forget_values(self):
+        # filters would hold back unchanged values the cache lets through
+        self.homie_value_cache.clear()
+        for publish_filter in self.homie_filters.values():
+            publish_filter.reset()
+
+    def homie_publish_dps_objects(self, dps_objects):
+        index = self.homie_value_index
+        now = time.monotonic()
+        for dp in dps_objects:
+            if dp.value_type == "bitmap":
+                keys = [(dp.name, b) for b in dp.bitmap]
+            else:
+                keys = [(dp.name, None)]
+            for key in keys:
+                entry = index.get(key)
+                if entry is None:
+                    continue
+                topic, encode, publish_filter = entry
+                message = encode(dp.value)
+                if publish_filter is not None:
+                    message = publish_filter.offer(dp.value, message, now)
+                    if message is None:
+                        continue
+                self.homie_publish_value(topic, message)
+        if self.homie_aggregates:
+            now = time.time()
+            for dp in dps_objects:
+                if isinstance(dp.value, bool) or not isinstance(dp.value, (int, float)):
+                    continue
+                for topic, aggregate in self.homie_aggregates.get(dp.name, ()):
+                    result = aggregate.add(dp.value, now)
+                    if result is not None:
+                        self.homie_publish_value(topic, encode_value(result))
+
+    def homie_publish_aggregates(self):
+        # windows that ended without a new value
+        now = time.time()
+        for topic, aggregate in self.homie_aggregate_topics.items():
+            result = aggregate.due(now)
+            if result is not None:
+                self.homie_publish_value(topic, encode_value(result))
+
+    def homie_publish_filtered(self):
+        # held back changes and keepalives of filtered properties
+        now = time.monotonic()
+        for topic, publish_filter in self.homie_filters.items():
+            message = publish_filter.due(now)
+            if message is not None:
+                self.homie_value_cache[topic] = message
+                self.homie_publish_data(topic, message)
+
+    def homie_snapshot_file(self):
+        return os.path.join(DEVICE_SNAPSHOT_DIR, "{}.json".format(self.id))
+
+    def homie_save_snapshot(self):
+        """Persist schema, description and last values for a warm start."""
+        if not DEVICE_SNAPSHOT_DIR or self.homie_fingerprint is None:
+            return
+        snapshot = {
+            "fingerprint": self.homie_fingerprint,
+            "state": self.homie_state,
+            "dps": self.homie_snapshot_dps,
+            "attributes": self.homie_attributes,
+            "values": self.homie_value_cache,
+        }
+        filename = self.homie_snapshot_file()
+        try:
+            os.makedirs(DEVICE_SNAPSHOT_DIR, exist_ok=True)
+            with open(filename + ".tmp", "w") as f:
+                json.dump(snapshot, f, default=str)
+            os.replace(filename + ".tmp", filename)
+        except Exception as e:
+            logger.error(
+                "Could not save snapshot of {} due to {}.".format(self.label, e)
+            )
+
+    def homie_warm_start(self):
+        """Publish the description and values of the last run before connecting.
+
+        The first live homie init reconciles against the snapshot and only
+        publishes what changed.
+        """
+        if not DEVICE_SNAPSHOT_DIR:
+            return
+        try:
+            with open(self.homie_snapshot_file()) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(
+                "Could not load snapshot of {} due to {}.".format(self.label, e)
+            )
+            return
+        self.status = {"dps_objects": [SimpleNamespace(**dp) for dp in snapshot["dps"]]}
+        self.homie_snapshot_dps = snapshot["dps"]
+        self.homie_from_snapshot = True
+        self.create_homie_device_info()
+        for topic, message in snapshot["attributes"].items():
+            self.homie_publish(topic, message)
+        for topic, message in snapshot["values"].items():
+            # with MQTT_MESSAGE_EXPIRY values expire as when published live
+            self.homie_publish_data(topic, message)
+        self.homie_attributes = snapshot["attributes"]
+        self.homie_fingerprint = snapshot["fingerprint"]
+        self.homie_value_cache.update(snapshot["values"])
+        if snapshot["state"] == "ready":
+            self.homie_publish_device_state("ready")
+        logger.info("Published snapshot of {}.".format(self.label))
+
+    def homie_warm_start_group(self):
+        # called by the I/O owner as it starts, not for the whole fleet up front
+        for m in [self] + list(self.children.values()):
+            m.homie_warm_start()
 
     def homie_init(self, offline=True):
         logger.info("Intialising homie for {}...".format(self.label))
-        # set device to init
-        self.homie_publish_device_state("init")
+        if self.homie_republish:
+            self.homie_republish = False
+            self.homie_attributes = {}
+            self.homie_fingerprint = None
+            self.homie_forget_values()
         self.create_homie_device_info()
+
+        # render description and discovery then publish only what changed
+        self.homie_staged_attributes = {}
         self.homie_init_device()
         self.hass_publish_configs()
         self.homie_publish_device_info()
-        self.homie_init_time = datetime.now()
+        attributes = self.homie_staged_attributes
+        self.homie_staged_attributes = {}
+        fingerprint = hashlib.sha1(
+            json.dumps(attributes, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        self.do_homie_init = False
+
+        if fingerprint == self.homie_fingerprint:
+            logger.info("Homie description of {} is unchanged.".format(self.label))
+            if self.homie_state != "ready":
+                self.homie_publish_device_state("ready")
+            return
+
+        # set device to init
+        self.homie_publish_device_state("init")
+        published = 0
+        for topic, message in attributes.items():
+            if self.homie_attributes.get(topic, None) != message:
+                self.homie_publish(topic, message)
+                published += 1
+        for topic in self.homie_attributes:
+            if topic not in attributes:
+                # clear retained attributes and discovery of removed properties
+                self.homie_publish(topic, "")
+                published += 1
+        self.homie_attributes = attributes
+        self.homie_fingerprint = fingerprint
+        self.homie_snapshot_dps = [
+            {k: getattr(dp, k) for k in DP_SCHEMA_FIELDS + ("value",) if hasattr(dp, k)}
+            for dp in self.status["dps_objects"]
+        ]
 
         # device ready
         self.homie_publish_device_state("ready")
-        logger.info("Intialised homie for {}.".format(self.label))
-        self.do_homie_init = False
+        logger.info(
+            "Intialised homie for {} ({} of {} attributes published).".format(
+                self.label, published, len(attributes)
+            )
+        )
+        self.homie_save_snapshot()
 
-    def tuya_connect(self):
+    def mqtt_connected(self):
+        # broker may have lost retained messages so republish everything,
+        # called by paho so the I/O owner forgets what was published
+        self.homie_republish = True
+        self.do_homie_init = True
+        self.tuya_wakeup()
+
+    def tuya_disconnected(self):
         self.tuya_connected = False
-        while not self.tuya_connected:
+        # republish the description (or at least $state=ready) on reconnect
+        self.do_homie_init = True
+        if self.homie_state == "ready" and not self.homie_from_snapshot:
+            # bridge stays connected so the will cannot signal this device
+            self.homie_publish_device_state("lost")
+            self.homie_save_snapshot()
+        for child in self.children.values():
+            child.tuya_disconnected()
+
+    def tuya_address_changed(self):
+        self.address_changed = True
+        self.tuya_wakeup()
+
+    def tuya_wakeup(self):
+        # called from other threads to interrupt a wait of the I/O owner
+        if self.event_loop is not None:
+            self.event_loop.call_soon_threadsafe(self.async_wakeup)
+        elif self.wakeup_w is not None:
             try:
-                logger.info("Connecting to {}...".format(self.label))
-                self.device = tinytuya.MappedDevice(
-                    dev_id=self.id,
-                    local_key=self.key,
-                    persist=True,
-                    expand_bitmaps=False,
-                )
-                self.device.set_version(self.version)
-                self.status = self.device.status()
-                logger.info("Fetched status of {}...".format(self.label))
-                self.tuya_connected = True
-                logger.info("Connected to {}...".format(self.label))
-            except:
-                self.tuya_connected = False
-                logger.error("Cound not connect to {}".format(self.label))
-                time.sleep(DEVICE_RECONNECT_SECONDS)
+                self.wakeup_w.send(b"\0")
+            except (BlockingIOError, OSError):
+                pass  # already pending
 
-    def loop(self):
-        while True:
-            # try:
-            if not self.tuya_connected:
-                self.tuya_connect()
-            if self.do_homie_init or datetime.now() > self.homie_init_time + timedelta(
-                seconds=HOMIE_INIT_SECONDS
-            ):
-                self.status = self.device.status()
-                logger.info("Fetched status of {}...".format(self.label))
-                if "dps_objects" in self.status:
-                    self.homie_init()
-                else:
-                    logger.error(
-                        "No dps_objects in status. {} is probably disconnected.".format(
-                            self.label
-                        )
-                    )
-                    self.tuya_connected = False
-            if datetime.now() > self.homie_publish_all_time + timedelta(
-                seconds=HOMIE_PUBLISH_ALL_SECONDS
-            ):
-                data = self.device.status()
-                logger.info("Fetched status of {}...".format(self.label))
-                self.status = data
-                self.homie_publish_all_time = datetime.now()
-            else:
-                # See if any data is available
-                logger.debug("Receiving data from {}...".format(self.label))
-                data = self.device.receive()
+    def tuya_wait(self, timeout, sock=None):
+        """Wait for device data or a wakeup, returns True if sock is readable."""
+        # poll() as select() fails for descriptors above 1023
+        poller = select.poll()
+        poller.register(self.wakeup_r, select.POLLIN)
+        if sock is not None:
+            poller.register(sock, select.POLLIN)
+        ready = {fd for fd, _ in poller.poll(timeout * 1000)}
+        if self.wakeup_r.fileno() in ready:
+            try:
+                while self.wakeup_r.recv(64):
+                    pass
+            except (BlockingIOError, OSError):
+                pass
+        return sock is not None and sock.fileno() in ready
 
-            if data != None:
-                if "dps_printable" in data:
-                    logger.info(
-                        "Received Payload from {}: {}".format(
-                            self.label, data["dps_printable"]
-                        )
+    def tuya_queue_command(self, tuya_code, value, callback=None):
+        """Queue a DP write for the I/O owner.
+
+        callback(monitor, error) is called once the device confirms the
+        write (error None) or when it reports another value, times out or is
+        superseded by a write of another value before it was sent.
+        """
+        superseded = ()
+        with self.command_lock:
+            if not self.pending_commands:
+                self.pending_commands_time = time.monotonic()
+            elif self.pending_commands.get(tuya_code, value) != value:
+                superseded = self.command_callbacks.pop(tuya_code, ())
+            # last value wins for repeated writes to the same DP
+            self.pending_commands[tuya_code] = value
+            if callback is not None:
+                self.command_callbacks.setdefault(tuya_code, []).append(callback)
+        self.tuya_run_callbacks(tuya_code, superseded, "superseded")
+        self.tuya_wakeup()
+
+    def tuya_command_done(self, tuya_code, error=None):
+        self.tuya_run_callbacks(
+            tuya_code, self.confirmation_callbacks.pop(tuya_code, ()), error
+        )
+
+    def tuya_run_callbacks(self, tuya_code, callbacks, error):
+        for callback in callbacks:
+            try:
+                callback(self, error)
+            except Exception:
+                logger.exception(
+                    "Command callback for {} of {} failed.".format(
+                        tuya_code, self.label
                     )
-                if "dps_objects" in data:
-                    self.tuya_last_data_time = datetime.now()
-                    self.homie_publish_dps_objects(data["dps_objects"])
-            elif datetime.now() > self.tuya_last_data_time + timedelta(
-                seconds=DEVICE_ASSUME_DEAD_SECONDS
-            ):
-                logger.error("No recent data from {}".format(self.label))
-                self.tuya_connected = False
+                )
 
-            # Send keyalive heartbeat
-            logger.debug(" > Send Heartbeat Ping to {} < ".format(self.label))
-            payload = self.device.generate_payload(tinytuya.HEART_BEAT)
-            self.device.send(payload)
-        # except:
-        #    logger.error("Error in loop for device {}".format(self.label))
-        #    self.tuya_connected = False
-        #    time.sleep(DEVICE_RECONNECT_SECONDS)
+    def tuya_command_delay(self):
+        """Seconds until pending commands should be sent, None if there are none."""
+        delay = None
+        with self.command_lock:
+            if self.pending_commands:
+                delay = max(
+                    0,
+                    self.pending_commands_time
+                    + DEVICE_COMMAND_COALESCE_SECONDS
+                    - time.monotonic(),
+                )
+        for child in self.children.values():
+            child_delay = child.tuya_command_delay()
+            if child_delay is not None and (delay is None or child_delay < delay):
+                delay = child_delay
+        return delay
 
+    def tuya_send_commands(self):
+        for child in self.children.values():
+            # sub device commands carry their cid over this connection
+            child.tuya_send_commands()
+        with self.command_lock:
+            commands = self.pending_commands
+            self.pending_commands = {}
+            callbacks = self.command_callbacks
+            self.command_callbacks = {}
+        for tuya_code, queued in callbacks.items():
+            self.confirmation_callbacks.setdefault(tuya_code, []).extend(queued)
+        if not commands:
+            return
+        # responses arrive through receive() like any other update
+        if len(commands) == 1:
+            ((tuya_code, value),) = commands.items()
+            self.device.set_value(tuya_code, value, nowait=True)
+        else:
+            self.device.set_multiple_values(commands, nowait=True)
+        logger.info("Set tuya codes {} for {}.".format(commands, self.label))
 
-def start_device_monitor(device_info):
-    dm = DeviceMonitor(device_info)
-    dm.loop()
+        sent_time = time.monotonic()
+        for tuya_code, value in commands.items():
+            self.pending_confirmations[tuya_code] = (value, sent_time)
+            if HOMIE_OPTIMISTIC_ECHO:
+                entry = self.homie_value_index.get((tuya_code, None))
+                if entry is not None:
+                    topic, encode, publish_filter = entry
+                    message = encode(value)
+                    if publish_filter is not None:
+                        # the reported value is filtered against the echo
+                        publish_filter.published(value, message, sent_time)
+                    self.homie_publish_value(topic, message)
 
+    def homie_forget_echo(self, tuya_code):
+        """Forget an echoed value so the device value is published again."""
+        entry = self.homie_value_index.get((tuya_code, None))
+        if entry is not None:
+            self.homie_value_cache.pop(entry[0], None)
+            if entry[2] is not None:
+                entry[2].reset()
 
-if __name__ == "__main__":
-    logger.info("Starting tuya_mqtt...")
+    def tuya_confirm_commands(self, dps_objects):
+        now = time.monotonic()
+        for dp in dps_objects:
+            pending = self.pending_confirmations.pop(dp.name, None)
+            if pending is None:
+                continue
+            value, sent_time = pending
+            rtt = now - sent_time
+            stats = self.command_latency.setdefault(
+                dp.name, {"count": 0, "last": 0, "max": 0, "total": 0}
+            )
+            stats["count"] += 1
+            stats["last"] = rtt
+            stats["max"] = max(stats["max"], rtt)
+            stats["total"] += rtt
+            logger.debug("{} confirmed {} in {:.3f}s.".format(self.label, dp.name, rtt))
+            if dp.value != value:
+                # the device value is published next and corrects any echo
+                self.homie_forget_echo(dp.name)
+                logger.error(
+                    "{} set {} to {} but reports {}.".format(
+                        self.label, dp.name, value, dp.value
+                    )
+                )
+                self.tuya_command_done(dp.name, "reports {}".format(dp.value))
+            else:
+                self.tuya_command_done(dp.name)
 
-    devices_info = []
+    def tuya_check_confirmations(self):
+        now = time.monotonic()
+        expired = [
+            tuya_code
+            for tuya_code, (value, sent_time) in self.pending_confirmations.items()
+            if now - sent_time > DEVICE_COMMAND_CONFIRM_SECONDS
+        ]
+        if not expired:
+            return
+        logger.error(
+            "{} did not confirm {} within {}s.".format(
+                self.label, expired, DEVICE_COMMAND_CONFIRM_SECONDS
+            )
+        )
+        for tuya_code in expired:
+            del self.pending_confirmations[tuya_code]
+            self.tuya_command_done(tuya_code, "not confirmed")
+            self.homie_forget_echo(tuya_code)
+        self.device.status(nowait=True)
 
-    # Read Devices.json
-    try:
-        # Load defaults
-        logger.debug("Loading device file {}...".format(DEVICE_FILE))
-        with open(DEVICE_FILE) as f:
-            devices_info = json.load(f)
-    except:
-        # No Device info
-        logger.error("Device file not found.")
-        exit()
+    def tuya_address_stale(self):
+        """Whether the cached address should be replaced by a network scan."""
+        if self.address_failures < DEVICE_RESCAN_FAILURES:
+            return False
+        # the listener reports address changes of devices it hears
+        return self.listener is None or self.listener.get(self.id) is None
 
-    # create threads
-    logger.info("Creating device threads...")
+    def tuya_resolve_address(self):
+        """Address to connect to, scanning when it is unknown or stale."""
+        address = self.addresses.get(self.id)
+        if address != self.address:
+            # a new address gets its own retries before a scan
+            self.address_failures = 0
+        if address is None and 0 < self.address_failures < DEVICE_RESCAN_FAILURES:
+            # the last scan missed it, wait a round of attempts for the next
+            self.address_failures += 1
+        elif address is None or self.tuya_address_stale():
+            address = self.addresses.rescan(self.id)
+            # a fruitless scan is the first failure of the next round
+            self.address_failures = 0 if address is not None else 1
+        if address is None:
+            self.tuya_last_error = "not found on the network"
+            logger.error("Could not find {} on the network.".format(self.label))
+        return address
 
-    threads = []
-    for di in devices_info:
-        threads.append(threading.Thread(target=start_device_monitor, args=(di,)))
+    def tuya_connect_once(self, address):
+        self.address_changed = False
+        self.address = address
+        try:
+            logger.info("Connecting to {} at {}...".format(self.label, address))
+            self.device = tinytuya.MappedDevice(
+                dev_id=self.id,
+                address=address,
+                local_key=self.key,
+                persist=True,
+                expand_bitmaps=False,
+            )
+            self.device.set_version(self.version)
+            for child in self.children.values():
+                child.tuya_attach(self.device)
+            self.status = self.tuya_status()
+            logger.info("Fetched status of {}...".format(self.label))
+            self.tuya_connected = "dps_objects" in self.status or (
+                # gateways may have no data points of their own
+                bool(self.children)
+                and self.device.socket is not None
+            )
+            if not self.tuya_connected:
+                self.tuya_last_error = self.status.get("Error", "no dps_objects")
+        except Exception as e:
+            self.tuya_last_error = e
+            self.tuya_connected = False
+        if self.tuya_connected:
+            self.address_failures = 0
+            logger.info("Connected to {}...".format(self.label))
+        else:
+            self.address_failures += 1
+            logger.error(
+                "Cound not connect to {} due to {}".format(
+                    self.label, self.tuya_last_error
+                )
+            )
+        return self.tuya_connected
+
+    def tuya_reconnect_attempt(self):
+        # scans take seconds and must not hold a reconnect slot
+        address = self.tuya_resolve_address()
+        if address is None:
+            connected = False
+        else:
+            with self.reconnects.slot():
+                connected = self.tuya_connect_once(address)
+        if self.homie_from_snapshot:
+            # the first attempt confirms or corrects the snapshot state
+            self.homie_from_snapshot = False
+            if not connected and self.homie_state == "ready":
+                self.homie_publish_device_state("lost")
+        for child in self.children.values():
+            if child.homie_from_snapshot and not connected:
+                child.homie_from_snapshot = False
+                child.tuya_disconnected()
+        if connected:
+            self.connects += 1
+            self.reconnects.succeeded(self.id)
+            self.tuya_last_data_time = time.monotonic()
+            self.tuya_schedule_timers()
+        else:
+            self.connect_failures += 1
+            self.reconnects.failed(self.id, self.tuya_last_error)
+        return connected
+
+    def tuya_reconnect_delay(self):
+        delay = self.reconnects.delay(self.id)
+        logger.info(
+            "Retrying {} in {:.1f}s (attempt {}).".format(
+                self.label, delay, self.reconnects.state(self.id)["attempts"]
+            )
+        )
+        return delay
+
+    def tuya_connect(self):
+        self.tuya_disconnected()
+        while not self.stopped and not self.tuya_reconnect_attempt():
+            self.tuya_wait(self.tuya_reconnect_delay())
+
+    def device_group(self):
+        return [self.device_info] + [c.device_info for c in self.children.values()]
+
+    def stop(self, remove=False):
+        """Ask the I/O owner to shut down, remove also clears discovery."""
+        self.remove = remove
+        self.stopped = True
+        self.tuya_wakeup()
+
+    def tuya_shutdown(self):
+        # called by the I/O owner once its loop has ended
+        self.timer_generation += 1
+        self.bridge.unregister(self)
+        if self.listener is not None:
+            self.listener.unregister(self)
+        if self.remove:
+            self.homie_publish_device_state("disconnected")
+            for topic in self.homie_attributes:
+                if topic.startswith(HASS_BASE_TOPIC + "/"):
+                    self.homie_publish(topic, "")
+            if DEVICE_SNAPSHOT_DIR and os.path.exists(self.homie_snapshot_file()):
+                os.remove(self.homie_snapshot_file())
+        else:
+            self.homie_save_snapshot()
+        for child in self.children.values():
+            child.remove = child.remove or self.remove
+            child.tuya_shutdown()
+        if self.device is not None:
+            self.device.close()
+        if self.startup is not None:
+            self.startup.device_ready(self)
+            self.startup = None
+        if self.wakeup_r is not None:
+            self.wakeup_r.close()
+            self.wakeup_w.close()
+        logger.info("Stopped monitoring {}.".format(self.label))
+        self.finished.set()
+
+    def timer_due(self, kind, generation):
+        # called by DeviceTimers, the I/O owner performs the action
+        if generation == self.timer_generation and not self.stopped:
+            self.due.add(kind)
+            self.tuya_wakeup()
+
+    def tuya_take_due(self, kind):
+        if kind in self.due:
+            self.due.discard(kind)
+            return True
+        return False
+
+    def tuya_schedule_timers(self):
+        # timers left over from an earlier connection are ignored
+        self.timer_generation += 1
+        self.due.clear()
+        self.timers.schedule(self, "poll", 0)
+        self.timers.schedule(self, "heartbeat", DEVICE_HEARTBEAT_SECONDS)
+        self.timers.schedule(self, "init", HOMIE_INIT_SECONDS)
+        self.timers.schedule(self, "dead", DEVICE_ASSUME_DEAD_SECONDS)
+
+    def homie_init_due(self):
+        if self.tuya_take_due("init"):
+            self.timers.schedule(self, "init", HOMIE_INIT_SECONDS)
+            return True
+        return self.do_homie_init
+
+    def tuya_homie_init(self):
+        self.status = self.tuya_status()
+        logger.info("Fetched status of {}...".format(self.label))
+        for child in self.children.values():
+            child.do_homie_init = True
+        if "dps_objects" in self.status or self.children:
+            if "dps_objects" in self.status:
+                self.homie_init()
+            else:
+                self.do_homie_init = False
+            if self.startup is not None:
+                self.startup.device_ready(self)
+                self.startup = None
+        else:
+            logger.error(
+                "No dps_objects in status. {} is probably disconnected.".format(
+                    self.label
+                )
+            )
+            self.tuya_connected = False
+
+    def tuya_children_homie_init(self):
+        for child in self.children.values():
+            if child.do_homie_init:
+                child.tuya_homie_init()
+
+    def tuya_poll_children(self):
+        # responses arrive through the gateway's receive()
+        for child in self.children.values():
+            if child.tuya_connected:
+                child.device.status(nowait=True)
+            else:
+                child.do_homie_init = True
+
+    def tuya_poll_due(self):
+        if self.tuya_take_due("poll"):
+            self.timers.schedule(self, "poll", self.poll_seconds)
+            self.homie_full_refresh_if_due()
+            return True
+        return False
+
+    def tuya_heartbeat_due(self):
+        if self.tuya_take_due("heartbeat"):
+            self.timers.schedule(self, "heartbeat", DEVICE_HEARTBEAT_SECONDS)
+            return True
+        return False
+
+    def tuya_check_dead(self):
+        if not self.tuya_take_due("dead"):
+            return
+        silent = time.monotonic() - self.tuya_last_data_time
+        if silent > DEVICE_ASSUME_DEAD_SECONDS:
+            logger.error("No recent data from {}".format(self.label))
+            self.tuya_connected = False
+        else:
+            self.timers.schedule(self, "dead", DEVICE_ASSUME_DEAD_SECONDS - silent)
+
+    def tuya_route_children(self, data):
+        """Hand sub device data to its monitor, returns data of this device."""
+        device = data.get("device") if data is not None else None
+        if device is not None:
+            self.tuya_last_data_time = time.monotonic()
+        for child in self.children.values():
+            child.tuya_process(data if device is child.device else None)
+        return data if device is None else None
+
+    def tuya_process(self, data):
+        if self.children:
+            data = self.tuya_route_children(data)
+        if data != None:
+            if "dps_printable" in data:
+                logger.info(
+                    "Received Payload from {}: {}".format(
+                        self.label, data["dps_printable"]
+                    )
+                )
+            if "dps_objects" in data:
+                self.messages_received += 1
+                self.tuya_last_data_time = time.monotonic()
+                if self.pending_confirmations:
+                    self.tuya_confirm_commands(data["dps_objects"])
+                self.homie_publish_dps_objects(data["dps_objects"])
+        if self.pending_confirmations and self.tuya_connected:
+            self.tuya_check_confirmations()
+        if self.homie_filters:
+            self.homie_publish_filtered()
+        if self.homie_aggregates:
+            self.homie_publish_aggregates()
+        if self.address_changed:
+            logger.info("Reconnecting to {} at new address...".format(self.label))
+            self.tuya_connected = False
+
+    def tuya_status(self):
+        start = time.monotonic()
+        data = self.device.status()
+        # a gateway may read sub device pushes before its own reply, hand
+        # them on and keep reading (bounded as children may be chatty)
+        reads = 0
+        while self.children and data is not None and data.get("device") is not None:
+            self.tuya_route_children(data)
+            if reads == 10:
+                data = None
+                break
+            reads += 1
+            data = self.tuya_receive()
+        self.status_latency.observe(time.monotonic() - start)
+        return data if data is not None else {"Error": "no status reply"}
+
+    def tuya_receive(self):
+        start = time.monotonic()
+        data = self.device.receive()
+        if isinstance(data, tuple):
+            # pushes parked by tinytuya come back as (sub device, data)
+            device, data = data
+            if device is not None and data is not None:
+                data.setdefault("device", device)
+        self.receive_latency.observe(time.monotonic() - start)
+        return data
+
+    def tuya_parked(self):
+        """Whether tinytuya parked sub device pushes read by a status()."""
+        return bool(getattr(self.device, "received_wrong_cid_queue", None))
+
+    def metric_samples(self, now):
+        labels = {"device": self.homie_device_id}
+        samples = [
+            ("tuya_mqtt_device_connected", "", labels, int(bool(self.tuya_connected))),
+            ("tuya_mqtt_device_received_total", "", labels, self.messages_received),
+            ("tuya_mqtt_device_published_total", "", labels, self.messages_published),
+            ("tuya_mqtt_device_connects_total", "", labels, self.connects),
+            (
+                "tuya_mqtt_device_connect_failures_total",
+                "",
+                labels,
+                self.connect_failures,
+            ),
+            (
+                "tuya_mqtt_device_publish_cache_hits_total",
+                "",
+                labels,
+                self.publish_cache_hits,
+            ),
+            (
+                "tuya_mqtt_device_publish_cache_misses_total",
+                "",
+                labels,
+                self.publish_cache_misses,
+            ),
+            (
+                "tuya_mqtt_device_last_data_age_seconds",
+                "",
+                labels,
+                now - self.tuya_last_data_time,
+            ),
+        ]
+        samples.extend(
+            self.status_latency.samples("tuya_mqtt_device_status_seconds", labels)
+        )
+        samples.extend(
+            self.receive_latency.samples("tuya_mqtt_device_receive_seconds", labels)
+        )
+        for tuya_code, stats in list(self.command_latency.items()):
+            code_labels = dict(labels, code=tuya_code)
+            samples.append(
+                (
+                    "tuya_mqtt_device_command_seconds",
+                    "_sum",
+                    code_labels,
+                    stats["total"],
+                )
+            )
+            samples.append(
+                (
+                    "tuya_mqtt_device_command_seconds",
+                    "_count",
+                    code_labels,
+                    stats["count"],
+                )
+            )
+        return samples
+
+    def tuya_heartbeat(self):
+        # Send keyalive heartbeat
+        logger.debug(" > Send Heartbeat Ping to {} < ".format(self.label))
+        payload = self.device.generate_payload(tinytuya.HEART_BEAT)
+        self.device.send(payload)
+
+    def loop(self):
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.homie_warm_start_group()
+        while not self.stopped:
+            # try:
+            if not self.tuya_connected:
+                self.tuya_connect()
+                if self.stopped:
+                    break
+            if self.homie_init_due():
+                self.tuya_homie_init()
+            self.tuya_children_homie_init()
+            delay = self.tuya_command_delay()
+            if delay is not None:
+                # let commands arriving within the window join this frame
+                time.sleep(delay)
+                self.tuya_send_commands()
+            if self.tuya_poll_due():
+                data = self.tuya_status()
+                logger.info("Fetched status of {}...".format(self.label))
+                self.status = data
+                self.tuya_poll_children()
+            elif self.device.socket is None or self.tuya_parked():
+                # let tinytuya reopen its persistent socket or hand over
+                # parked pushes, which are not on the socket any more
+                data = self.tuya_receive()
+            else:
+                # wait for data, a command or a timer
+                logger.debug("Receiving data from {}...".format(self.label))
+                data = None
+                if self.tuya_wait(DEVICE_RECEIVE_TIMEOUT_SECONDS, self.device.socket):
+                    data = self.tuya_receive()
+
+            self.tuya_process(data)
+            self.tuya_check_dead()
+            if self.tuya_connected and self.tuya_heartbeat_due():
+                self.tuya_heartbeat()
+        # except:
+        #    logger.error("Error in loop for device {}".format(self.label))
+        #    self.tuya_connected = False
+        #    time.sleep(DEVICE_RECONNECT_SECONDS)
+        self.tuya_shutdown()
+
+    async def tuya_readable(self, timeout):
+        """Wait until the device socket has data without blocking the event loop."""
+        sock = self.device.socket
+        if sock is None:
+            return False
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+
+        def on_readable():
+            if not readable.done():
+                readable.set_result(True)
+
+        self.async_waiter = readable
+        loop.add_reader(sock.fileno(), on_readable)
+        try:
+            return await asyncio.wait_for(readable, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.async_waiter = None
+            loop.remove_reader(sock.fileno())
+
+    def async_wakeup(self):
+        self.async_wakeup_event.set()
+        if self.async_waiter is not None and not self.async_waiter.done():
+            self.async_waiter.set_result(False)
+
+    async def async_wait_wakeup(self, timeout):
+        try:
+            await asyncio.wait_for(self.async_wakeup_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.async_wakeup_event.clear()
+
+    def tuya_loop_limits(self, on_loop):
+        """Set how hard tinytuya tries on this connection.
+
+        On the event loop a dropped connection is reported instead of being
+        reconnected with blocking connects and sleeps, sends do not wait for
+        the response the loop reads anyway and a partial frame or full send
+        buffer gives up after DEVICE_ASYNC_SOCKET_TIMEOUT_SECONDS.  Off the
+        loop tinytuya keeps its own retries and timeout so a full status
+        fetch can read past empty acks.
+        """
+        if on_loop:
+            self.tuya_blocking_limits = (
+                self.device.socketRetryLimit,
+                self.device.sendWait,
+                self.device.connection_timeout,
+            )
+            self.device.set_socketRetryLimit(0)
+            self.device.set_sendWait(None)
+            self.device.set_socketTimeout(DEVICE_ASYNC_SOCKET_TIMEOUT_SECONDS)
+        else:
+            retry_limit, send_wait, timeout = self.tuya_blocking_limits
+            self.device.set_socketRetryLimit(retry_limit)
+            self.device.set_sendWait(send_wait)
+            self.device.set_socketTimeout(timeout)
+
+    async def async_run_blocking(self, engine, fn):
+        # the calls of fn may reconnect and sleep, so run them off the loop
+        self.tuya_loop_limits(False)
+        try:
+            return await engine.run_blocking(fn)
+        finally:
+            self.tuya_loop_limits(True)
+
+    async def async_loop(self, engine):
+        self.async_wakeup_event = asyncio.Event()
+        self.event_loop = asyncio.get_running_loop()
+        # snapshot files are read off the event loop
+        await engine.run_blocking(self.homie_warm_start_group)
+        while not self.stopped:
+            if not self.tuya_connected:
+                self.tuya_disconnected()
+                while not self.stopped and not await engine.run_blocking(
+                    self.tuya_reconnect_attempt
+                ):
+                    await self.async_wait_wakeup(self.tuya_reconnect_delay())
+                if self.stopped:
+                    break
+                # a new tinytuya device was created by the attempt
+                self.tuya_loop_limits(True)
+            if self.homie_init_due():
+                await self.async_run_blocking(engine, self.tuya_homie_init)
+                if not self.tuya_connected:
+                    continue
+            if any(child.do_homie_init for child in self.children.values()):
+                await self.async_run_blocking(engine, self.tuya_children_homie_init)
+
+            data = None
+            if self.device.socket is None:
+                # persistent socket was closed by tinytuya, sending now would
+                # reconnect on the event loop
+                self.tuya_connected = False
+                continue
+            delay = self.tuya_command_delay()
+            if delay is not None:
+                await asyncio.sleep(delay)
+                self.tuya_send_commands()
+            if self.tuya_poll_due():
+                # response is picked up by the reader below
+                logger.info("Requesting status of {}...".format(self.label))
+                self.device.status(nowait=True)
+                self.tuya_poll_children()
+
+            if self.tuya_parked() or await self.tuya_readable(
+                DEVICE_RECEIVE_TIMEOUT_SECONDS
+            ):
+                logger.debug("Receiving data from {}...".format(self.label))
+                data = self.tuya_receive()
+
+            self.tuya_process(data)
+            self.tuya_check_dead()
+            if self.tuya_connected and self.tuya_heartbeat_due():
+                self.tuya_heartbeat()
+        self.event_loop = None
+        self.tuya_shutdown()
+
+
+class SubDeviceMonitor(DeviceMonitor):
+    """Sub device of a gateway, e.g. a zigbee sensor.
+
+    Sub devices have no connection or loop of their own.  The gateway's
+    monitor owns the connection, hands each sub device the status messages
+    carrying its cid and sends its commands.
+    """
+
+    def __init__(self, device_info, gateway):
+        super().__init__(
+            device_info,
+            gateway.bridge,
+            gateway.addresses,
+            gateway.reconnects,
+            gateway.timers,
+            gateway=gateway,
+        )
+        self.version = gateway.version
+        self.cid = device_info.get("node_id") or device_info.get("cid") or self.id
+
+    def tuya_attach(self, parent):
+        # called by the gateway for every new connection
+        self.device = tinytuya.MappedDevice(
+            dev_id=self.id,
+            cid=self.cid,
+            parent=parent,
+            local_key=self.key,
+            persist=True,
+            expand_bitmaps=False,
+        )
+
+    def tuya_wakeup(self):
+        self.gateway.tuya_wakeup()
+
+    def tuya_homie_init(self):
+        self.homie_from_snapshot = False
+        super().tuya_homie_init()
+        if "dps_objects" in self.status:
+            self.tuya_connected = True
+        else:
+            self.tuya_disconnected()
+        # retried on the next poll of the gateway
+        self.do_homie_init = False
+
+    def tuya_shutdown(self):
+        # the gateway closes the shared connection
+        self.device = None
+        super().tuya_shutdown()
+
+    def get_hass_config_template(self):
+        config_template = super().get_hass_config_template()
+        config_template["device"]["via_device"] = self.gateway.homie_device_id
+        return config_template
+
+
+class GroupCommand:
+    """Outcome of a group set command, completed by its members."""
+
+    def __init__(self, tuya_code, message, members):
+        self.tuya_code = tuya_code
+        self.message = message
+        self.start = time.monotonic()
+        self.pending = set(members)  # member labels
+        self.results = {}  # member label -> {"ok", "seconds" or "error"}
+
+    def finish(self, member, error=None):
+        """Record the outcome of a member, True once none are pending."""
+        if member not in self.pending:
+            return False
+        self.pending.discard(member)
+        result = {"ok": error is None}
+        if error is None:
+            result["seconds"] = round(time.monotonic() - self.start, 3)
+        else:
+            result["error"] = error
+        self.results[member] = result
+        return not self.pending
+
+
+class DeviceGroup:
+    """Homie device whose set commands fan out to member devices.
+
+    A set is queued on every member at once so each member's I/O owner sends
+    it on its own connection, the scene takes one device round trip instead
+    of one per member.  The value is published once a member confirms and a
+    per member result is published to status/result.
+    """
+
+    def __init__(self, name, settings, registry, bridge, timers):
+        self.name = name
+        self.label = name
+        self.homie_device_id = format_homie_id(name)
+        self.members = list(settings.get("devices", ()))
+        self.registry = registry
+        self.bridge = bridge
+        self.timers = timers
+        self.timer_generation = 0
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.commands = {}  # sequence -> GroupCommand
+
+        properties = []
+        for tuya_code, spec in settings.get("codes", {}).items():
+            # datatype or (datatype, format)
+            datatype, format = (spec, None) if isinstance(spec, str) else spec
+            properties.append(
+                HomieProperty(
+                    format_homie_id(tuya_code),
+                    tuya_code,
+                    tuya_code,
+                    datatype,
+                    settable=True,
+                    format=format,
+                )
+            )
+        self.homie_set_index = {p.topic: p for p in properties}
+        self.homie_device_info = HomieDevice(
+            name,
+            (
+                HomieNode("data", "Data", tuple(properties)),
+                HomieNode(
+                    "status",
+                    "Status",
+                    (
+                        HomieProperty(
+                            "result", "result", "Last command result", "string"
+                        ),
+                    ),
+                ),
+            ),
+        )
+        self.result_topic = "{}/{}/status/result".format(
+            HOMIE_BASE_TOPIC, self.homie_device_id
+        )
+
+        self.bridge.register(self)
+        if self.bridge.connected:
+            self.homie_publish_description()
+
+    def get_hass_config_template(self):
+        return {
+            "availability": [
+                {
+                    "topic": self.bridge.state_topic,
+                    "payload_available": "ready",
+                    "payload_not_available": "lost",
+                },
+            ],
+            "device": {
+                "identifiers": [self.homie_device_id],
+                "model": "Device group",
+                "name": self.name,
+                "via_device": MQTT_CLIENT_ID,
+            },
+        }
+
+    def homie_publish_description(self):
+        state_topic = "{}/{}/$state".format(HOMIE_BASE_TOPIC, self.homie_device_id)
+        self.bridge.publish(state_topic, "init")
+        for topic, message in homie_attributes(
+            self.homie_device_id, self.homie_device_info
+        ):
+            self.bridge.publish(topic, message)
+        # only the commandable data node is discovered, results are for logs
+        common = json.dumps(self.get_hass_config_template())[1:-1]
+        for topic, message in hass_configs(
+            self.homie_device_id, self.homie_device_info.nodes[:1], common, self.label
+        ):
+            self.bridge.publish(topic, message)
+        self.bridge.publish(state_topic, "ready")
+
+    def mqtt_connected(self):
+        self.homie_publish_description()
+
+    def member_monitors(self):
+        with self.registry.lock:
+            monitors = list(self.registry.monitors.values())
+        by_name = {}
+        for monitor in monitors:
+            by_name.setdefault(monitor.id, monitor)
+            by_name.setdefault(monitor.name, monitor)
+        found = []
+        missing = []
+        for member in self.members:
+            monitor = by_name.get(member)
+            if monitor is None:
+                logger.error("No device {} for group {}.".format(member, self.label))
+                missing.append(member)
+            elif monitor not in found:
+                found.append(monitor)
+        return found, missing
+
+    def homie_message(self, client, userdata, message):
+        m = str(message.payload.decode("utf-8"))
+        logger.info(
+            "Received MQTT message topic={}, message={}".format(message.topic, m)
+        )
+        topics = message.topic.split("/")
+        p = self.homie_set_index.get(topics[3]) if topics[2] == "data" else None
+        if p is None:
+            logger.error(
+                "Unknown property topic {} for group {}.".format(
+                    message.topic, self.label
+                )
+            )
+            return
+        try:
+            v = HOMIE_PARSERS[p.datatype](m)
+        except (KeyError, ValueError):
+            logger.error("Invalid message {} for {} type.".format(m, p.datatype))
+            return
+
+        monitors, missing = self.member_monitors()
+        command = GroupCommand(
+            p.tuya_code, m, [mon.label for mon in monitors] + missing
+        )
+        for member in missing:
+            command.finish(member, "unknown device")
+        command_id = next(self.sequence)
+        with self.lock:
+            self.commands[command_id] = command
+        self.timers.schedule(
+            self,
+            command_id,
+            DEVICE_COMMAND_CONFIRM_SECONDS + DEVICE_COMMAND_COALESCE_SECONDS + 1,
+        )
+        for monitor in monitors:
+            entry = monitor.homie_set_index.get(p.topic)
+            if not monitor.tuya_connected:
+                self.member_done(command_id, monitor, "not connected")
+            elif entry is None or not entry[2]:
+                self.member_done(
+                    command_id, monitor, "no settable {}".format(p.tuya_code)
+                )
+            else:
+                monitor.tuya_queue_command(
+                    p.tuya_code,
+                    v,
+                    lambda monitor, error: self.member_done(command_id, monitor, error),
+                )
+        if not monitors:
+            self.command_done(command_id)
+
+    def member_done(self, command_id, monitor, error=None):
+        # called by the I/O owner of the member or a superseding write
+        with self.lock:
+            command = self.commands.get(command_id)
+            done = command is not None and command.finish(monitor.label, error)
+        if done:
+            self.command_done(command_id)
+
+    def timer_due(self, kind, generation):
+        # deadline of a command, members that did not answer timed out
+        self.command_done(kind)
+
+    def command_done(self, command_id):
+        with self.lock:
+            command = self.commands.pop(command_id, None)
+        if command is None:
+            return
+        for member in list(command.pending):
+            command.finish(member, "timeout")
+        seconds = time.monotonic() - command.start
+        confirmed = [r for r in command.results.values() if r["ok"]]
+        if confirmed:
+            self.bridge.publish(
+                "{}/{}/data/{}".format(
+                    HOMIE_BASE_TOPIC,
+                    self.homie_device_id,
+                    format_homie_id(command.tuya_code),
+                ),
+                command.message,
+            )
+        result = {
+            "property": command.tuya_code,
+            "value": command.message,
+            "seconds": round(seconds, 3),
+            "members": command.results,
+        }
+        self.bridge.publish(self.result_topic, json.dumps(result))
+        log = logger.info if len(confirmed) == len(command.results) else logger.error
+        log(
+            "Group {} set {} on {} of {} devices in {:.3f}s.".format(
+                self.label,
+                command.tuya_code,
+                len(confirmed),
+                len(command.results),
+                seconds,
+            )
+        )
+
+
+class TokenBucket:
+    """Blocking token bucket refilled at rate tokens per second."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class StartupScheduler:
+    """Starts device monitors concurrently, highest priority first.
+
+    A token bucket limits how fast device connects begin and a cap limits how
+    many devices may be starting at once.  A device that is not ready within
+    DEVICE_STARTUP_TIMEOUT_SECONDS gives up its slot and keeps retrying, it
+    is counted as not ready in the startup report.
+    """
+
+    def __init__(
+        self,
+        concurrency=DEVICE_STARTUP_CONCURRENCY,
+        rate=DEVICE_STARTUP_RATE,
+        burst=DEVICE_STARTUP_BURST,
+        timeout=DEVICE_STARTUP_TIMEOUT_SECONDS,
+    ):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate, burst)
+        self.condition = threading.Condition()
+        self.starting = {}  # monitor -> start time
+        self.pending = set()  # monitors neither ready nor timed out yet
+        self.timed_out = set()  # monitors not ready within the timeout
+        self.start_time = None
+
+    def priority(self, monitor):
+        try:
+            return float(monitor.device_info.get(DEVICE_PRIORITY_FIELD, 0))
+        except (TypeError, ValueError):
+            return 0
+
+    def run(self, monitors, start):
+        """Call start(monitor) for every monitor, blocking until all started."""
+        self.start_time = time.monotonic()
+        ordered = sorted(monitors, key=self.priority, reverse=True)
+        with self.condition:
+            self.pending.update(ordered)
+        logger.info("Starting {} devices...".format(len(ordered)))
+        for m in ordered:
+            self.bucket.take()
+            with self.condition:
+                while len(self.starting) >= self.concurrency:
+                    self.release_timed_out()
+                    self.condition.wait(1)
+                self.starting[m] = time.monotonic()
+            m.startup = self
+            start(m)
+        logger.info(
+            "Started all {} devices in {:.1f}s.".format(
+                len(ordered), time.monotonic() - self.start_time
+            )
+        )
+        # the last devices started only time out if someone checks
+        threading.Thread(target=self.wait_settled, name="startup", daemon=True).start()
+
+    def wait_settled(self):
+        with self.condition:
+            while self.pending:
+                self.release_timed_out()
+                self.condition.wait(1)
+
+    def release_timed_out(self):
+        now = time.monotonic()
+        for m, started in list(self.starting.items()):
+            if now - started > self.timeout:
+                logger.error(
+                    "{} not ready after {}s, starting others.".format(
+                        m.label, self.timeout
+                    )
+                )
+                del self.starting[m]
+                self.timed_out.add(m)
+                self.device_settled(m)
+
+    def device_ready(self, monitor):
+        with self.condition:
+            self.starting.pop(monitor, None)
+            self.timed_out.discard(monitor)
+            self.device_settled(monitor)
+            self.condition.notify_all()
+
+    def device_settled(self, monitor):
+        # called with the condition held once monitor is ready or timed out
+        if monitor not in self.pending:
+            return
+        self.pending.discard(monitor)
+        if self.pending:
+            return
+        elapsed = time.monotonic() - self.start_time
+        if self.timed_out:
+            logger.error(
+                "All devices ready or timed out {:.1f}s after startup, {} not ready.".format(
+                    elapsed, len(self.timed_out)
+                )
+            )
+        else:
+            logger.info("All devices ready {:.1f}s after startup.".format(elapsed))
+
+
+class ThreadEngine:
+    """Runs every device monitor loop in its own thread."""
+
+    def __init__(self):
+        self.threads = []
+
+    def start(self, monitor):
+        thread = threading.Thread(target=monitor.loop, name=monitor.label)
+        self.threads.append(thread)
+        thread.start()
+
+    def run(self, monitors, scheduler, started):
+        logger.info("Starting device threads...")
+        scheduler.run(monitors, self.start)
+        started()
+        for thread in self.threads:
+            thread.join()
+
+
+class AsyncioEngine:
+    """Runs every device monitor on one asyncio event loop.
+
+    Socket reads are driven by the event loop.  Only connection setup and the
+    full status fetch of a homie init are handed to a small executor.
+    """
+
+    def __init__(self, connect_workers=DEVICE_ASYNC_CONNECT_WORKERS):
+        self.executor = ThreadPoolExecutor(
+            max_workers=connect_workers, thread_name_prefix="tuya_connect"
+        )
+        self.tasks = set()
+        self.loop = None
+
+    async def run_blocking(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def start_task(self, monitor):
+        task = asyncio.create_task(monitor.async_loop(self), name=monitor.label)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def start(self, monitor):
+        # may be called from any thread
+        self.loop.call_soon_threadsafe(self.start_task, monitor)
+
+    async def main(self, monitors, scheduler, started):
+        self.loop = asyncio.get_running_loop()
+        logger.info("Starting device tasks...")
+        # the scheduler blocks on its rate limit so run it off the event loop
+        await self.loop.run_in_executor(None, scheduler.run, monitors, self.start)
+        started()
+        await self.loop.create_future()
+
+    def run(self, monitors, scheduler, started):
+        asyncio.run(self.main(monitors, scheduler, started))
+
+
+class Histogram:
+    """Cumulative latency histogram with fixed buckets."""
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        samples = []
+        total = 0
+        for le, count in zip(self.buckets, self.counts):
+            total += count
+            samples.append((name, "_bucket", dict(labels, le=str(le)), total))
+        total += self.counts[-1]
+        samples.append((name, "_bucket", dict(labels, le="+Inf"), total))
+        samples.append((name, "_sum", labels, self.sum))
+        samples.append((name, "_count", labels, total))
+        return samples
+
+
+METRIC_TYPES = {
+    "tuya_mqtt_mqtt_connected": ("gauge", "1 if the MQTT connection is up."),
+    "tuya_mqtt_mqtt_queued": ("gauge", "MQTT packets waiting to be written."),
+    "tuya_mqtt_mqtt_inflight": ("gauge", "QoS 1 messages waiting for PUBACK."),
+    "tuya_mqtt_mqtt_topic_aliases": ("gauge", "MQTT 5 topic aliases in use."),
+    "tuya_mqtt_worker_up": ("gauge", "1 if the worker reported metrics."),
+    "tuya_mqtt_device_connected": ("gauge", "1 if the device is connected."),
+    "tuya_mqtt_device_received_total": ("counter", "Device messages with data points."),
+    "tuya_mqtt_device_published_total": ("counter", "MQTT messages published."),
+    "tuya_mqtt_device_connects_total": ("counter", "Successful device connects."),
+    "tuya_mqtt_device_connect_failures_total": ("counter", "Failed device connects."),
+    "tuya_mqtt_device_publish_cache_hits_total": (
+        "counter",
+        "Data values not published as they were unchanged.",
+    ),
+    "tuya_mqtt_device_publish_cache_misses_total": (
+        "counter",
+        "Data values published as they changed.",
+    ),
+    "tuya_mqtt_device_last_data_age_seconds": (
+        "gauge",
+        "Seconds since the device last sent data points.",
+    ),
+    "tuya_mqtt_device_status_seconds": ("histogram", "Duration of status() calls."),
+    "tuya_mqtt_device_receive_seconds": ("histogram", "Duration of receive() calls."),
+    "tuya_mqtt_device_command_seconds": (
+        "summary",
+        "Set command round trip until the device confirmed the value.",
+    ),
+}
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics(samples):
+    """Prometheus text exposition of (name, suffix, labels, value) samples."""
+    by_name = {}
+    for name, suffix, labels, value in samples:
+        by_name.setdefault(name, []).append((suffix, labels, value))
+    lines = []
+    for name, name_samples in by_name.items():
+        kind, help_text = METRIC_TYPES.get(name, ("untyped", name))
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for suffix, labels, value in name_samples:
+            label_text = ",".join(
+                '{}="{}"'.format(k, escape_label(v)) for k, v in labels.items()
+            )
+            if label_text:
+                label_text = "{" + label_text + "}"
+            lines.append("{}{}{} {}".format(name, suffix, label_text, value))
+    return "\n".join(lines) + "\n"
+
+
+def metric_samples(registry):
+    now = time.monotonic()
+    with registry.lock:
+        monitors = list(registry.monitors.values())
+    samples = registry.bridge.metric_samples()
+    for m in monitors:
+        samples.extend(m.metric_samples(now))
+    return samples
+
+
+class MetricsServer:
+    """Serves collect() as Prometheus text on http://METRICS_BIND:METRICS_PORT/metrics."""
+
+    def __init__(self, collect, port=METRICS_PORT, bind=METRICS_BIND):
+        self.collect = collect
+        self.port = port
+        self.bind = bind
+
+    def start(self):
+        collect = self.collect
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render_metrics(collect()).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics request: " + format % args)
+
+        server = ThreadingHTTPServer((self.bind, self.port), Handler)
+        server.daemon_threads = True
+        threading.Thread(
+            target=server.serve_forever, name="metrics", daemon=True
+        ).start()
+        logger.info("Serving metrics on {}:{}.".format(self.bind, self.port))
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads for a while, on demand.
+
+    Samples are attributed to the DeviceMonitor whose method is innermost on
+    the stack, other threads by name, and counted per function both as the
+    running function (own) and anywhere on the stack (total).  The report is
+    written to PROFILE_DIR.  No thread or hook exists between profiles.
+    """
+
+    def __init__(self, directory=PROFILE_DIR, interval=PROFILE_INTERVAL_SECONDS):
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, seconds=PROFILE_SECONDS):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                logger.error("A profile is already running.")
+                return
+            self.thread = threading.Thread(
+                target=self.run, args=(seconds,), name="profiler", daemon=True
+            )
+            self.thread.start()
+
+    def on_sigusr1(self, signum, frame):
+        self.start()
+
+    def install(self):
+        # must be called from the main thread to install the signal handler
+        signal.signal(signal.SIGUSR1, self.on_sigusr1)
+
+    def run(self, seconds):
+        logger.info("Profiling for {}s...".format(seconds))
+        own = {}  # (owner, function) -> samples
+        total = {}
+        owners = {}  # owner -> samples
+        me = threading.get_ident()
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.sample(frame, names.get(ident, ident), own, total, owners)
+            time.sleep(self.interval)
+        self.write(seconds, own, total, owners)
+
+    def sample(self, frame, thread_name, own, total, owners):
+        owner = None
+        functions = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append(
+                "{} ({}:{})".format(
+                    getattr(code, "co_qualname", code.co_name),
+                    os.path.basename(code.co_filename),
+                    code.co_firstlineno,
+                )
+            )
+            if owner is None and code.co_argcount and code.co_varnames[0] == "self":
+                monitor = frame.f_locals.get("self")
+                if isinstance(monitor, DeviceMonitor):
+                    owner = monitor.label
+            frame = frame.f_back
+        if owner is None:
+            owner = "[{}]".format(thread_name)
+        owners[owner] = owners.get(owner, 0) + 1
+        key = (owner, functions[0])
+        own[key] = own.get(key, 0) + 1
+        for function in set(functions):
+            key = (owner, function)
+            total[key] = total.get(key, 0) + 1
+
+    def write(self, seconds, own, total, owners):
+        lines = [
+            "Profile of pid {} over {}s, sampled every {}s.".format(
+                os.getpid(), seconds, self.interval
+            ),
+            "Blocking waits (select, sleep) show as own time.",
+        ]
+        for owner, samples in sorted(owners.items(), key=lambda o: -o[1]):
+            lines.append("")
+            lines.append("{} ({} samples)".format(owner, samples))
+            lines.append("{:>7} {:>7}  function".format("own%", "total%"))
+            functions = sorted(
+                (k[1] for k in total if k[0] == owner),
+                key=lambda f: (-total[(owner, f)], -own.get((owner, f), 0)),
+            )
+            for function in functions[:PROFILE_TOP_FUNCTIONS]:
+                lines.append(
+                    "{:7.1f} {:7.1f}  {}".format(
+                        100 * own.get((owner, function), 0) / samples,
+                        100 * total[(owner, function)] / samples,
+                        function,
+                    )
+                )
+        filename = os.path.join(
+            self.directory,
+            "profile-{}-{}.txt".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid()),
+        )
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(filename, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            logger.info("Wrote profile to {}.".format(filename))
+        except OSError as e:
+            logger.error("Could not write profile {} due to {}.".format(filename, e))
+
+
+class DeviceRegistry:
+    """Running device monitors by device id.
+
+    Applies a reloaded device list: new devices get monitors, removed devices
+    are shut down and changed devices are restarted.  Other devices are not
+    touched.  A gateway and its sub devices are restarted together.
+    """
+
+    def __init__(self, bridge, addresses, reconnects, timers, listener):
+        self.bridge = bridge
+        self.addresses = addresses
+        self.reconnects = reconnects
+        self.timers = timers
+        self.listener = listener
+        self.monitors = {}  # device id -> DeviceMonitor, sub devices included
+        self.groups = {}  # name -> DeviceGroup run by this process
+        self.lock = threading.Lock()
+        self.engine = None
+        # set once the first monitors are started, reloads wait for it
+        self.started = threading.Event()
+
+    def create(self, group):
+        """Monitor of a device group, sub devices are attached to the gateway."""
+        monitor = DeviceMonitor(
+            group[0],
+            self.bridge,
+            self.addresses,
+            self.reconnects,
+            self.timers,
+            self.listener,
+        )
+        for device_info in group[1:]:
+            monitor.children[device_info["id"]] = SubDeviceMonitor(device_info, monitor)
+        with self.lock:
+            for m in [monitor] + list(monitor.children.values()):
+                self.monitors[m.id] = m
+        return monitor
+
+    def run(self, devices_info, engine):
+        self.engine = engine
+        logger.info("Creating device monitors...")
+        monitors = [
+            self.create(group) for group in device_groups(devices_info).values()
+        ]
+        self.apply_groups(devices_info)
+        engine.run(monitors, StartupScheduler(), self.started.set)
+
+    def apply_groups(self, devices_info):
+        """Run the DEVICE_GROUPS with devices in devices_info.
+
+        Workers are sharded so the devices of a group are all in one shard.
+        """
+        names = {di["id"] for di in devices_info} | {di["name"] for di in devices_info}
+        for name, settings in DEVICE_GROUPS.items():
+            group = self.groups.get(name)
+            if names.intersection(settings.get("devices", ())):
+                if group is None:
+                    self.groups[name] = DeviceGroup(
+                        name, settings, self, self.bridge, self.timers
+                    )
+            elif group is not None:
+                # its devices moved to another worker, which runs it now
+                self.bridge.unregister(self.groups.pop(name))
+
+    def apply(self, devices_info):
+        # a reload during startup must not race the first monitors
+        self.started.wait()
+        wanted = device_groups(devices_info)
+        with self.lock:
+            current = {
+                dev_id: m for dev_id, m in self.monitors.items() if m.gateway is None
+            }
+
+        removed = []
+        restarted = []
+        for dev_id, m in current.items():
+            if dev_id not in wanted:
+                logger.info("Removing {}...".format(m.label))
+                m.stop(remove=True)
+                removed.append(m)
+            elif wanted[dev_id] != m.device_group():
+                logger.info(
+                    "Restarting {} as its device entry changed...".format(m.label)
+                )
+                names = {di["id"]: di["name"] for di in wanted[dev_id]}
+                for child in m.children.values():
+                    # sub devices gone from the file or renamed clear their discovery
+                    child.remove = child.id not in names or (
+                        format_homie_id(names[child.id]) != child.homie_device_id
+                    )
+                # a renamed device gets a new homie id, clear the old one
+                m.stop(remove=format_homie_id(names[m.id]) != m.homie_device_id)
+                restarted.append(m)
+        for m in removed + restarted:
+            # the old connection must be closed before a new one is made
+            if not m.finished.wait(DEVICE_STOP_TIMEOUT_SECONDS):
+                logger.error("{} did not stop in time.".format(m.label))
+            with self.lock:
+                for stopped in [m] + list(m.children.values()):
+                    if self.monitors.get(stopped.id) is stopped:
+                        del self.monitors[stopped.id]
+
+        started = [wanted[m.id] for m in restarted]
+        added = [group for dev_id, group in wanted.items() if dev_id not in current]
+        if added:
+            self.addresses.discover([group[0] for group in added])
+        started.extend(added)
+        if started:
+            monitors = [self.create(group) for group in started]
+            StartupScheduler().run(monitors, self.engine.start)
+        self.apply_groups(devices_info)
+        logger.info(
+            "Applied device file: {} added, {} removed, {} restarted.".format(
+                len(added), len(removed), len(restarted)
+            )
+        )
+
+
+def load_devices(filename=DEVICE_FILE):
+    try:
+        logger.debug("Loading device file {}...".format(filename))
+        with open(filename) as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error("Could not load device file {} due to {}.".format(filename, e))
+        return None
+
+
+class DeviceFileWatcher:
+    """Reloads the device file on SIGHUP or when it changes on disk."""
+
+    def __init__(self, apply, filename=DEVICE_FILE, interval=DEVICE_FILE_WATCH_SECONDS):
+        self.apply = apply
+        self.filename = filename
+        self.interval = interval
+        self.reload_event = threading.Event()
+        self.mtime = None
+
+    def modified(self):
+        try:
+            return os.stat(self.filename).st_mtime
+        except OSError:
+            return None
+
+    def on_sighup(self, signum, frame):
+        self.reload_event.set()
+
+    def start(self):
+        # must be called from the main thread to install the signal handler
+        self.mtime = self.modified()
+        signal.signal(signal.SIGHUP, self.on_sighup)
+        threading.Thread(target=self.run, name="device_file", daemon=True).start()
+
+    def run(self):
+        while True:
+            requested = self.reload_event.wait(
+                self.interval if self.interval > 0 else None
+            )
+            self.reload_event.clear()
+            mtime = self.modified()
+            if not requested and mtime == self.mtime:
+                continue
+            self.mtime = mtime
+            devices_info = load_devices(self.filename)
+            if devices_info is not None:
+                logger.info("Reloading device file {}...".format(self.filename))
+                self.apply(devices_info)
+
+
+class HashRing:
+    """Consistent hashing of device ids onto worker numbers."""
+
+    def __init__(self, workers, replicas=100):
+        self.ring = sorted(
+            (self.hash("{}-{}".format(w, r)), w)
+            for w in workers
+            for r in range(replicas)
+        )
+        self.keys = [k for k, _ in self.ring]
+
+    def hash(self, key):
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def get(self, key):
+        i = bisect.bisect(self.keys, self.hash(key)) % len(self.keys)
+        return self.ring[i][1]
+
+
+class Supervisor:
+    """Shards devices over worker processes and restarts workers that die.
+
+    Workers report health over a pipe every SUPERVISOR_REPORT_SECONDS and the
+    supervisor logs the aggregate.  Reloaded device lists are resharded and
+    sent to the workers whose shard changed.
+    """
+
+    def __init__(self, devices_info, workers=SUPERVISOR_WORKERS):
+        self.workers = workers
+        self.ring = HashRing(range(workers))
+        self.shards = self.shard(devices_info)
+        self.processes = {}  # worker -> Process
+        self.connections = {}  # worker -> supervisor end of the pipe
+        self.health = {}  # worker -> last health report
+        self.restarts = ReconnectScheduler(concurrency=workers)
+        self.restart_times = {}  # worker -> monotonic time of next restart
+        self.reloaded_devices = None  # set by the file watcher thread
+        # forking copies locks held by the supervisor's threads, e.g. the
+        # logging handler's, into the worker where nobody releases them
+        self.processes_context = multiprocessing.get_context("spawn")
+
+    def shard(self, devices_info):
+        # devices of a device group share a worker so the group reaches them
+        owner_keys = device_group_keys(devices_info)
+        shards = {w: [] for w in range(self.workers)}
+        for di in devices_info:
+            # sub devices share their gateway's connection and worker
+            owner = device_gateway_id(di) or di["id"]
+            shards[self.ring.get(owner_keys.get(owner, owner))].append(di)
+        return shards
+
+    def apply(self, devices_info):
+        # applied by the supervisor loop
+        self.reloaded_devices = devices_info
+
+    def apply_reloaded_devices(self):
+        devices_info, self.reloaded_devices = self.reloaded_devices, None
+        for worker, shard in self.shard(devices_info).items():
+            if shard == self.shards[worker]:
+                continue
+            self.shards[worker] = shard
+            if worker in self.connections:
+                logger.info(
+                    "Sending {} devices to worker {}.".format(len(shard), worker)
+                )
+                try:
+                    self.connections[worker].send(shard)
+                except (BrokenPipeError, OSError):
+                    pass  # restarted workers get their new shard
+
+    def start_worker(self, worker):
+        connection, worker_connection = self.processes_context.Pipe()
+        process = self.processes_context.Process(
+            target=run_worker,
+            args=(worker, self.shards[worker], worker_connection),
+            name="tuya_mqtt-{}".format(worker),
+            daemon=True,
+        )
+        process.start()
+        worker_connection.close()
+        self.processes[worker] = process
+        self.connections[worker] = connection
+        logger.info(
+            "Started worker {} (pid {}) with {} devices.".format(
+                worker, process.pid, len(self.shards[worker])
+            )
+        )
+
+    def worker_died(self, worker):
+        process = self.processes.pop(worker)
+        process.join(1)
+        self.connections.pop(worker).close()
+        self.health.pop(worker, None)
+        self.restarts.failed(worker, process.exitcode)
+        delay = self.restarts.delay(worker)
+        logger.error(
+            "Worker {} exited with code {}, restarting in {:.1f}s.".format(
+                worker, process.exitcode, delay
+            )
+        )
+        self.restart_times[worker] = time.monotonic() + delay
+
+    def receive(self, worker):
+        try:
+            self.health[worker] = self.connections[worker].recv()
+            self.restarts.succeeded(worker)
+        except (EOFError, OSError):
+            pass  # process sentinel reports the exit
+
+    def metric_samples(self):
+        # worker metrics are as recent as their last health report
+        samples = []
+        for worker in range(self.workers):
+            report = self.health.get(worker)
+            worker_labels = {"worker": str(worker)}
+            samples.append(
+                ("tuya_mqtt_worker_up", "", worker_labels, int(bool(report)))
+            )
+            if not report:
+                continue
+            for name, suffix, labels, value in report["metrics"]:
+                samples.append((name, suffix, dict(labels, **worker_labels), value))
+        return samples
+
+    def log_health(self):
+        totals = {}
+        for report in self.health.values():
+            for k, v in report.items():
+                if isinstance(v, (int, float)) and k not in ("worker", "pid"):
+                    totals[k] = totals.get(k, 0) + v
+        logger.info(
+            "{} of {} workers reporting: {}".format(
+                len(self.health), self.workers, totals
+            )
+        )
+
+    def on_sigusr1(self, signum, frame):
+        # devices run in the workers, each writes its own profile
+        for process in list(self.processes.values()):
+            try:
+                os.kill(process.pid, signal.SIGUSR1)
+            except (OSError, TypeError):
+                pass
+
+    def run(self):
+        for worker in self.shards:
+            self.start_worker(worker)
+        signal.signal(signal.SIGUSR1, self.on_sigusr1)
+        next_log = time.monotonic() + SUPERVISOR_REPORT_SECONDS
+        while True:
+            if self.reloaded_devices is not None:
+                self.apply_reloaded_devices()
+            now = time.monotonic()
+            for worker, restart_time in list(self.restart_times.items()):
+                if now >= restart_time:
+                    del self.restart_times[worker]
+                    self.start_worker(worker)
+            waiting = {c: ("message", w) for w, c in self.connections.items()}
+            waiting.update({p.sentinel: ("exit", w) for w, p in self.processes.items()})
+            for ready in multiprocessing.connection.wait(list(waiting), timeout=1):
+                event, worker = waiting[ready]
+                if event == "message" and worker in self.connections:
+                    self.receive(worker)
+                elif event == "exit" and worker in self.processes:
+                    self.worker_died(worker)
+            if time.monotonic() >= next_log:
+                self.log_health()
+                next_log = time.monotonic() + SUPERVISOR_REPORT_SECONDS
+
+
+def health_report(worker, registry):
+    with registry.lock:
+        monitors = list(registry.monitors.values())
+    return {
+        "worker": worker,
+        "pid": os.getpid(),
+        "devices": len(monitors),
+        "connected": sum(1 for m in monitors if m.tuya_connected),
+        "ready": sum(1 for m in monitors if m.homie_state == "ready"),
+        "published": sum(m.publish_cache_misses for m in monitors),
+        "unchanged": sum(m.publish_cache_hits for m in monitors),
+        "reconnecting": sum(
+            1 for m in monitors if m.reconnects.state(m.id)["attempts"] > 0
+        ),
+        "metrics": metric_samples(registry) if METRICS_PORT else [],
+    }
+
+
+def report_health(worker, registry, connection):
+    while True:
+        time.sleep(SUPERVISOR_REPORT_SECONDS)
+        try:
+            connection.send(health_report(worker, registry))
+        except (BrokenPipeError, OSError):
+            # supervisor is gone
+            os._exit(1)
+
+
+def receive_devices(registry, connection):
+    while True:
+        try:
+            devices_info = connection.recv()
+        except (EOFError, OSError):
+            # supervisor is gone
+            os._exit(1)
+        registry.apply(devices_info)
+
+
+def run_devices(devices_info, worker=None, connection=None):
+    """Run monitors for devices_info, optionally as a supervised worker."""
+    client_id = MQTT_CLIENT_ID
+    bridge_topic = MQTT_BRIDGE_TOPIC
+    if worker is not None:
+        client_id = "{}-{}".format(MQTT_CLIENT_ID, worker)
+        bridge_topic = "{}/{}".format(MQTT_BRIDGE_TOPIC, worker)
+
+    # reconnect backoff shared by all devices and mqtt
+    reconnects = ReconnectScheduler()
+
+    # on demand profiles of this process
+    profiler = SamplingProfiler()
+    profiler.install()
+
+    # shared mqtt connection
+    bridge = MqttBridge(
+        reconnects, client_id=client_id, base_topic=bridge_topic, profiler=profiler
+    )
+    bridge.connect(
+        host=MQTT_HOST,
+        port=MQTT_PORT,
+        username=MQTT_USERNAME,
+        password=MQTT_PASSWORD,
+        keepalive=MQTT_KEEPALIVE,
+    )
+    # monitors registered after the connection publish their snapshots
+    # instead of being reset by the connect callback
+    bridge.ready.wait(MQTT_KEEPALIVE)
+
+    # resolve device addresses once for the whole fleet
+    addresses = DeviceAddressCache()
+    addresses.load()
+    addresses.discover(devices_info)
+
+    # watch device broadcasts for address changes
+    listener = None
+    if DEVICE_ANNOUNCE_LISTENER:
+        listener = DeviceAnnouncementListener(addresses)
+        listener.start()
+
+    # heartbeat, poll and re-init deadlines of all devices
+    timers = DeviceTimers()
+    timers.start()
+
+    registry = DeviceRegistry(bridge, addresses, reconnects, timers, listener)
+    if connection is not None:
+        # the supervisor reports health and sends reloaded device lists
+        threading.Thread(
+            target=report_health,
+            args=(worker, registry, connection),
+            name="health",
+            daemon=True,
+        ).start()
+        threading.Thread(
+            target=receive_devices,
+            args=(registry, connection),
+            name="devices",
+            daemon=True,
+        ).start()
+    else:
+        DeviceFileWatcher(registry.apply).start()
+        if METRICS_PORT:
+            MetricsServer(lambda: metric_samples(registry)).start()
+
+    if DEVICE_ENGINE == "asyncio":
+        engine = AsyncioEngine()
+    else:
+        engine = ThreadEngine()
+    registry.run(devices_info, engine)
+
+
+def run_worker(worker, devices_info, connection):
+    logger.info(
+        "Worker {} starting with {} devices...".format(worker, len(devices_info))
+    )
+    run_devices(devices_info, worker, connection)
+
+
+if __name__ == "__main__":
+    logger.info("Starting tuya_mqtt...")
+
+    # Read Devices.json
+    devices_info = load_devices()
+    if devices_info is None:
+        # No Device info
+        exit()
 
-    logger.info("Starting device threads...")
-    for t in threads:
-        t.start()
-        time.sleep(DEVICE_THREAD_START_GAP_SECONDS)
+    if SUPERVISOR_WORKERS > 1:
+        # resolve addresses with one scan before the fleet is split up
+        addresses = DeviceAddressCache()
+        addresses.load()
+        addresses.discover(devices_info)
+        supervisor = Supervisor(devices_info)
+        DeviceFileWatcher(supervisor.apply).start()
+        if METRICS_PORT:
+            MetricsServer(supervisor.metric_samples).start()
+        supervisor.run()
+    else:
+        run_devices(devices_info)